@@ -2,12 +2,14 @@
 import pathlib
 from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from agent.tools_and_schemas import PromptRequest, PromptResult
 from agent.prompt_generator import generate_prompt
 from fastapi.staticfiles import StaticFiles
 
-# Define the FastAPI app
-app = FastAPI()
+# Define the FastAPI app. orjson (already a dependency) serializes API
+# responses to bytes in one pass instead of json.dumps over a dict copy.
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS for local dev + production web app.
 # LangGraph SDK uses preflighted requests (e.g. POST /threads), so OPTIONS must succeed.
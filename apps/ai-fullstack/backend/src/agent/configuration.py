@@ -70,6 +70,11 @@ class Configuration(BaseModel):
         },
     )
 
+    max_concurrent_searches: int = Field(
+        default=8,
+        metadata={"description": "Maximum number of web_research calls allowed to run concurrently."},
+    )
+
     search_model: str = Field(
         default="gemini-2.0-flash",
         metadata={"description": "Model to use for the search step (Gemini or GPT depending on provider)."},
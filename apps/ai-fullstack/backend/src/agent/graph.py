@@ -1,11 +1,29 @@
+import asyncio
+import functools
+import hashlib
+import heapq
+import io
+import math
 import os
 import json
-import urllib.request
-import urllib.error
+import re
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from operator import itemgetter
+
+import httpx
+
+try:  # Optional fast JSON decoder for large AutoRAG payloads.
+    import orjson as _orjson
+except ImportError:  # pragma: no cover - stdlib fallback
+    _orjson = None
 
 from agent.tools_and_schemas import RoleDecision, SafetyDecision, SearchQueryList, Reflection
 from dotenv import load_dotenv
-from openai import OpenAI, APIConnectionError, OpenAIError
+from openai import AsyncOpenAI, OpenAI, APIConnectionError, OpenAIError
+from pydantic import TypeAdapter
 from langchain_core.messages import AIMessage
 from langgraph.types import Send
 from langgraph.graph import StateGraph
@@ -23,6 +41,7 @@ from agent.configuration import Configuration
 from agent.prompts import (
     role_router_instructions,
     get_current_date,
+    render_prompt,
     query_writer_instructions,
     web_searcher_instructions,
     reflection_instructions,
@@ -30,16 +49,27 @@ from agent.prompts import (
 )
 from langchain_google_genai import ChatGoogleGenerativeAI
 from agent.utils import (
+    annotate_and_collect,
     format_messages_for_prompt,
-    get_citations,
     get_research_topic,
-    insert_citation_markers,
-    resolve_urls,
 )
 from agent.roles import DEFAULT_ROLE_ID, normalize_role_id, role_map, roles_prompt_block
 
 load_dotenv()
 
+# Environment flags/values read once at import (after load_dotenv): the debug flag was
+# previously re-read per streamed chunk, which is a syscall-ish lookup on a hot loop.
+_DEBUG_OPENAI = os.getenv("DEBUG_OPENAI_RESPONSES") == "1"
+_INTERNAL_API_SECRET = (os.getenv("INTERNAL_API_SECRET") or "").strip()
+_OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+
+def refresh_debug_flag() -> None:
+    """Re-read DEBUG_OPENAI_RESPONSES (for tests or live toggling)."""
+    global _DEBUG_OPENAI
+    _DEBUG_OPENAI = os.getenv("DEBUG_OPENAI_RESPONSES") == "1"
+
+
 ROLE_ALLOWED_CANVAS_TOOLS: dict[str, set[str]] = {
     # Creative operators
     "storyboard_artist": {"createNode", "updateNode", "connectNodes", "runNode"},
@@ -54,6 +84,221 @@ ROLE_ALLOWED_CANVAS_TOOLS: dict[str, set[str]] = {
     "magician": set(),
 }
 
+# Semantic response cache (opt-in via SEMANTIC_CACHE=1): paraphrased prompts to the
+# structured-output models and AutoRAG tend to repeat within a session; a cosine-similarity
+# lookup over prompt embeddings lets those calls return without an LLM/RAG round-trip.
+_SEMANTIC_CACHE_EMBEDDING_MODEL = "text-embedding-3-small"
+_SEMANTIC_CACHE_THRESHOLD = 0.92
+_SEMANTIC_CACHE_TTL_SECONDS = 3600
+_SEMANTIC_CACHE_MAX_ENTRIES = 1024
+
+
+_SEMANTIC_CACHE_LEXICAL_THRESHOLD = 0.6
+
+
+def _semantic_cache_enabled() -> bool:
+    """Return True when the embedding-based response cache is enabled."""
+    return os.getenv("SEMANTIC_CACHE") == "1"
+
+
+class _SemanticCache:
+    """LRU + TTL cache over prompt embeddings, partitioned by a namespace string.
+
+    Entries are matched with cosine similarity (>= threshold) against stored vectors
+    within the same namespace (e.g. "model|schema" or "autorag|rag_id"), so paraphrased
+    prompts can reuse a previous response.
+
+    A lexical trigram-Jaccard gate runs before any embedding: unique prompts that
+    share no surface overlap with cached ones short-circuit without paying the
+    embedding API call. Vectors are computed lazily, only when a candidate first
+    survives the gate.
+    """
+
+    def __init__(
+        self,
+        threshold: float = _SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = _SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = _SEMANTIC_CACHE_TTL_SECONDS,
+        lexical_threshold: float = _SEMANTIC_CACHE_LEXICAL_THRESHOLD,
+    ) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lexical_threshold = lexical_threshold
+        # key:int -> [namespace, text, trigrams, vector|None, norm, value, expires_at];
+        # ordered for LRU eviction, mutable so vectors can be filled in lazily.
+        self._entries: OrderedDict[int, list] = OrderedDict()
+        self._next_key = 0
+
+    @staticmethod
+    def _norm(vector: list[float]) -> float:
+        return math.sqrt(sum(x * x for x in vector))
+
+    @staticmethod
+    def _trigrams(text: str) -> frozenset:
+        """Character trigrams of the normalized text (works for CJK and latin)."""
+        t = " ".join(text.lower().split())
+        if len(t) < 3:
+            return frozenset((t,)) if t else frozenset()
+        return frozenset(t[i : i + 3] for i in range(len(t) - 2))
+
+    @staticmethod
+    def _jaccard(a: frozenset, b: frozenset) -> float:
+        if not a or not b:
+            return 0.0
+        inter = len(a & b)
+        if inter == 0:
+            return 0.0
+        return inter / (len(a) + len(b) - inter)
+
+    def lookup_text(self, text: str, namespace: str):
+        """Return the cached value for the most similar prompt, or None.
+
+        Embeds `text` only when at least one cached entry passes the lexical
+        gate; entries stored without a vector get embedded on first candidacy.
+        """
+        trigrams = self._trigrams(text)
+        now = time.monotonic()
+        candidates: list[int] = []
+        expired: list[int] = []
+        for key, entry in self._entries.items():
+            if entry[6] < now:
+                expired.append(key)
+                continue
+            if entry[0] != namespace:
+                continue
+            if self._jaccard(trigrams, entry[2]) >= self.lexical_threshold:
+                candidates.append(key)
+        for key in expired:
+            self._entries.pop(key, None)
+        if not candidates:
+            return None
+        vector = _embed_for_cache(text)
+        if not vector:
+            return None
+        query_norm = self._norm(vector)
+        if query_norm == 0.0:
+            return None
+        best_key = None
+        best_sim = self.threshold
+        for key in candidates:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry[3] is None:
+                entry[3] = _embed_for_cache(entry[1])
+                entry[4] = self._norm(entry[3]) if entry[3] else 0.0
+            vec, norm = entry[3], entry[4]
+            if not vec or norm == 0.0:
+                continue
+            sim = sum(a * b for a, b in zip(vector, vec)) / (query_norm * norm)
+            if sim >= best_sim:
+                best_sim = sim
+                best_key = key
+        if best_key is None:
+            return None
+        entry = self._entries.pop(best_key)
+        self._entries[best_key] = entry  # refresh LRU position
+        return entry[5]
+
+    def put_text(self, text: str, namespace: str, value) -> None:
+        """Store a response under the prompt text, evicting LRU entries when full.
+
+        No embedding happens here; the vector is filled in lazily if the entry
+        ever passes the lexical gate on a later lookup.
+        """
+        key = self._next_key
+        self._next_key += 1
+        self._entries[key] = [
+            namespace,
+            text,
+            self._trigrams(text),
+            None,
+            0.0,
+            value,
+            time.monotonic() + self.ttl_seconds,
+        ]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_SEMANTIC_RESPONSE_CACHE = _SemanticCache()
+
+# Exact-match prompt cache (in front of the semantic layer): structured calls use a
+# strict JSON schema over fixed prompt templates, so identical prompts reproduce the
+# same response. Hits skip the whole OpenAI round-trip at zero embedding cost.
+# On by default; disable with PROMPT_CACHE=0.
+_EXACT_PROMPT_CACHE: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_EXACT_PROMPT_CACHE_MAX_ENTRIES = 256
+_EXACT_PROMPT_CACHE_TTL_SECONDS = 3600
+
+
+def _exact_prompt_cache_enabled() -> bool:
+    """Return True unless the exact-match prompt cache is disabled via env."""
+    return os.getenv("PROMPT_CACHE") != "0"
+
+
+def _exact_cache_key(model: str, schema_name: str, prompt: str) -> str:
+    """Build the SHA256 cache key for one (model, schema, prompt) combination."""
+    return hashlib.sha256(f"{model}|{schema_name}|{prompt}".encode("utf-8")).hexdigest()
+
+
+def _exact_cache_get(key: str) -> str | None:
+    """Return the cached response text for the key, honoring TTL and LRU order."""
+    entry = _EXACT_PROMPT_CACHE.get(key)
+    if entry is None:
+        return None
+    text, expires_at = entry
+    if expires_at < time.monotonic():
+        _EXACT_PROMPT_CACHE.pop(key, None)
+        return None
+    _EXACT_PROMPT_CACHE.move_to_end(key)
+    return text
+
+
+def _exact_cache_put(key: str, text: str) -> None:
+    """Store a response text, evicting the least recently used entries when full."""
+    _EXACT_PROMPT_CACHE[key] = (text, time.monotonic() + _EXACT_PROMPT_CACHE_TTL_SECONDS)
+    _EXACT_PROMPT_CACHE.move_to_end(key)
+    while len(_EXACT_PROMPT_CACHE) > _EXACT_PROMPT_CACHE_MAX_ENTRIES:
+        _EXACT_PROMPT_CACHE.popitem(last=False)
+
+
+def _embed_for_cache(text: str) -> list[float] | None:
+    """Embed a prompt for semantic cache lookups; None when embedding is unavailable."""
+    try:
+        client = get_openai_client()
+        response = client.embeddings.create(
+            model=_SEMANTIC_CACHE_EMBEDDING_MODEL,
+            input=text[:8000],
+        )
+        return list(response.data[0].embedding)
+    except Exception:
+        return None
+
+
+def _toon_cell(value: str) -> str:
+    """Quote a table cell when it would collide with the comma delimiter."""
+    if "," in value or '"' in value or "\n" in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def _toon_table(name: str, columns: tuple[str, ...], rows: list[dict]) -> list[str]:
+    """Render homogeneous dict rows as a TOON-style header + value rows block.
+
+    One header row declares the keys, so they are not repeated per node —
+    this is what keeps large canvases cheap in prompt tokens.
+    """
+    used = tuple(c for c in columns if any(r.get(c) for r in rows))
+    if not used:
+        return []
+    lines = [f"{name}[{len(rows)}]{{{','.join(used)}}}:"]
+    for r in rows:
+        lines.append("  " + ",".join(_toon_cell(str(r.get(c) or "")) for c in used))
+    return lines
+
+
 def _render_canvas_context_for_prompt(canvas_context: dict | None) -> str:
     """Render a compact, safe canvas context summary for prompts.
 
@@ -106,50 +351,88 @@ def _render_canvas_context_for_prompt(canvas_context: dict | None) -> str:
 
     timeline = canvas_context.get("timeline")
     if isinstance(timeline, list) and timeline:
-        parts.append("timeline (top):")
+        rows: list[dict] = []
         for t in timeline[:6]:
             if not isinstance(t, dict):
                 continue
-            label = t.get("label") or t.get("nodeId")
-            kind = t.get("kind")
-            status = t.get("status")
             dur = t.get("duration")
-            bits: list[str] = []
-            if label:
-                bits.append(str(label)[:80])
-            if kind:
-                bits.append(f"kind={str(kind)[:24]}")
-            if status:
-                bits.append(f"status={str(status)[:16]}")
-            if isinstance(dur, (int, float)):
-                bits.append(f"duration={int(dur)}s")
-            if bits:
-                parts.append("- " + " | ".join(bits))
+            rows.append({
+                "label": str(t.get("label") or t.get("nodeId") or "")[:80],
+                "kind": str(t.get("kind") or "")[:24],
+                "status": str(t.get("status") or "")[:16],
+                "duration": f"{int(dur)}s" if isinstance(dur, (int, float)) else "",
+            })
+        parts.extend(_toon_table("timeline", ("label", "kind", "status", "duration"), rows))
 
     nodes = canvas_context.get("nodes")
     if isinstance(nodes, list) and nodes:
-        parts.append("nodes (sample):")
+        rows = []
         for n in nodes[:10]:
             if not isinstance(n, dict):
                 continue
-            label = n.get("label") or n.get("id")
-            kind = n.get("kind") or n.get("type")
-            status = n.get("status")
             prompt_preview = n.get("promptPreview")
-            bits: list[str] = []
-            if label:
-                bits.append(str(label)[:80])
-            if kind:
-                bits.append(f"kind={str(kind)[:24]}")
-            if status:
-                bits.append(f"status={str(status)[:16]}")
-            if isinstance(prompt_preview, str) and prompt_preview.strip():
-                bits.append(f"prompt='{prompt_preview.strip()[:120]}'")
-            if bits:
-                parts.append("- " + " | ".join(bits))
+            rows.append({
+                "label": str(n.get("label") or n.get("id") or "")[:80],
+                "kind": str(n.get("kind") or n.get("type") or "")[:24],
+                "status": str(n.get("status") or "")[:16],
+                "prompt": prompt_preview.strip()[:120] if isinstance(prompt_preview, str) else "",
+            })
+        parts.extend(_toon_table("nodes", ("label", "kind", "status", "prompt"), rows))
 
     return "\n".join(parts).strip()
 
+# Alternate key names seen across AutoRAG/tool payload shapes, hoisted so the
+# normalizers do one tuple-driven lookup instead of chained .get() calls.
+_ANSWER_KEYS = ("answer", "output", "response")
+_SOURCE_LIST_KEYS = ("sources", "results", "documents")
+_TITLE_KEYS = ("title", "label", "name")
+_URL_KEYS = ("url", "source_url", "source")
+_TEXT_KEYS = ("text", "content", "snippet")
+_SCORE_KEYS = ("score", "similarity")
+_DURATION_KEYS = ("durationSeconds", "duration", "duration_sec")
+_ASPECT_KEYS = ("aspectRatio", "aspect", "ratio")
+_STYLE_KEYS = ("style", "visualStyle", "look")
+_MUSIC_KEYS = ("musicSfx", "music", "sfx")
+_CHAR_REF_KEYS = ("ref", "label", "nodeId")
+
+
+def _first(d: dict, keys: tuple, default=None):
+    """Return the first truthy value of `keys` present in `d`."""
+    return next((d[k] for k in keys if k in d and d[k]), default)
+
+
+def _canvas_fingerprint(obj) -> bytes | str:
+    """Stable serialized form of a canvas context, for hashing/caching only."""
+    if _orjson is not None:
+        return _orjson.dumps(obj, option=_orjson.OPT_SORT_KEYS, default=str)
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _json_loads(data):
+    """Decode JSON, preferring orjson (operates on raw bytes) when available."""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8", errors="replace")
+    return json.loads(data)
+
+
+_JSON_CAP_ENCODER = json.JSONEncoder(ensure_ascii=False)
+
+
+def _json_cap(obj, cap: int = 4000) -> str:
+    """Serialize `obj` to JSON, stopping once `cap` characters are produced.
+
+    Avoids materializing a multi-MB dump just to slice the first few KB.
+    """
+    buf = io.StringIO()
+    for piece in _JSON_CAP_ENCODER.iterencode(obj):
+        buf.write(piece)
+        if buf.tell() >= cap:
+            break
+    return buf.getvalue()[:cap]
+
+
 def _autorag_normalize_result(result: dict) -> tuple[list[str], list[dict]]:
     """Best-effort normalize AutoRAG result into (snippets, sources)."""
     snippets: list[str] = []
@@ -158,19 +441,19 @@ def _autorag_normalize_result(result: dict) -> tuple[list[str], list[dict]]:
     if not isinstance(result, dict):
         return snippets, sources
 
-    answer = result.get("answer") or result.get("output") or result.get("response")
+    answer = _first(result, _ANSWER_KEYS)
     if isinstance(answer, str) and answer.strip():
         snippets.append(answer.strip())
 
-    raw_sources = result.get("sources") or result.get("results") or result.get("documents") or []
+    raw_sources = _first(result, _SOURCE_LIST_KEYS, [])
     if isinstance(raw_sources, list):
         for idx, item in enumerate(raw_sources[:8], start=1):
             if not isinstance(item, dict):
                 continue
-            title = item.get("title") or item.get("label") or item.get("name") or f"KB#{idx}"
-            url = item.get("url") or item.get("source_url") or item.get("source") or ""
-            text = item.get("text") or item.get("content") or item.get("snippet") or ""
-            score = item.get("score") or item.get("similarity") or None
+            title = _first(item, _TITLE_KEYS, f"KB#{idx}")
+            url = _first(item, _URL_KEYS, "")
+            text = _first(item, _TEXT_KEYS, "")
+            score = _first(item, _SCORE_KEYS)
             line_bits: list[str] = []
             if isinstance(title, str) and title.strip():
                 line_bits.append(title.strip())
@@ -190,50 +473,94 @@ def _autorag_normalize_result(result: dict) -> tuple[list[str], list[dict]]:
 
     if not snippets:
         try:
-            snippets.append(json.dumps(result, ensure_ascii=False)[:4000])
+            snippets.append(_json_cap(result))
         except Exception:
             snippets.append(str(result)[:4000])
     return snippets, sources
 
 
+# Pooled HTTP client for the AutoRAG proxy: keep-alive connections avoid paying
+# DNS + TLS handshake on every RAG query against the same Worker endpoint.
+_AUTORAG_HTTP_CLIENT: httpx.Client | None = None
+_AUTORAG_RETRY_STATUSES = (502, 503, 504)
+
+
+def _get_autorag_http_client() -> httpx.Client:
+    """Return the shared keep-alive HTTP client for AutoRAG requests."""
+    global _AUTORAG_HTTP_CLIENT
+    if _AUTORAG_HTTP_CLIENT is None:
+        _AUTORAG_HTTP_CLIENT = httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=32),
+            timeout=httpx.Timeout(20.0, connect=5.0),
+            transport=httpx.HTTPTransport(retries=2),
+        )
+    return _AUTORAG_HTTP_CLIENT
+
+
+_AUTORAG_ASYNC_HTTP_CLIENT: httpx.AsyncClient | None = None
+
+
+def _get_autorag_async_http_client() -> httpx.AsyncClient:
+    """Return the shared async HTTP client for concurrent AutoRAG requests."""
+    global _AUTORAG_ASYNC_HTTP_CLIENT
+    if _AUTORAG_ASYNC_HTTP_CLIENT is None:
+        _AUTORAG_ASYNC_HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=4, max_connections=32),
+            timeout=httpx.Timeout(20.0, connect=5.0),
+            transport=httpx.AsyncHTTPTransport(retries=2),
+        )
+    return _AUTORAG_ASYNC_HTTP_CLIENT
+
+
+def _autorag_post(endpoint: str, payload: dict, headers: dict) -> httpx.Response:
+    """POST to the AutoRAG proxy, retrying transient upstream errors with backoff."""
+    client = _get_autorag_http_client()
+    for attempt in range(3):
+        response = client.post(endpoint, json=payload, headers=headers)
+        if response.status_code in _AUTORAG_RETRY_STATUSES and attempt < 2:
+            time.sleep(0.3 * (2**attempt))
+            continue
+        break
+    return response
+
+
 def _call_autorag_search(configurable: Configuration, query: str) -> tuple[list[str], list[dict]]:
     """Call Worker-side AutoRAG proxy and return (web_research_result, sources_gathered)."""
     endpoint = (configurable.autorag_endpoint or "").strip()
     rag_id = (configurable.autorag_id or "").strip()
-    secret = (os.getenv("INTERNAL_API_SECRET") or "").strip()
+    secret = _INTERNAL_API_SECRET
     if not endpoint or not rag_id or not query.strip():
         return [], []
 
-    payload = json.dumps({"ragId": rag_id, "query": query}).encode("utf-8")
-    headers = {"content-type": "application/json"}
+    semantic_cache = _semantic_cache_enabled()
+    cache_namespace = f"autorag|{rag_id}"
+    if semantic_cache:
+        cached = _SEMANTIC_RESPONSE_CACHE.lookup_text(query, cache_namespace)
+        if cached is not None:
+            cached_snippets, cached_sources = cached
+            return list(cached_snippets), [dict(s) for s in cached_sources]
+
+    headers = {}
     if secret:
         headers["x-internal-secret"] = secret
-    req = urllib.request.Request(
-        endpoint,
-        method="POST",
-        data=payload,
-        headers=headers,
-    )
     try:
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            body = resp.read().decode("utf-8", errors="replace")
-    except urllib.error.HTTPError as exc:
-        try:
-            body = exc.read().decode("utf-8", errors="replace")
-        except Exception:
-            body = str(exc)
-        return [f"[AutoRAG] HTTP {exc.code}: {body[:2000]}"], []
+        resp = _autorag_post(endpoint, {"ragId": rag_id, "query": query}, headers)
+        body = resp.content
     except Exception as exc:
         return [f"[AutoRAG] 请求失败: {exc}"], []
+    if resp.status_code >= 400:
+        return [f"[AutoRAG] HTTP {resp.status_code}: {resp.text[:2000]}"], []
 
     try:
-        decoded = json.loads(body)
+        decoded = _json_loads(body)
     except Exception:
-        return [f"[AutoRAG] 非 JSON 响应: {body[:2000]}"], []
+        return [f"[AutoRAG] 非 JSON 响应: {resp.text[:2000]}"], []
 
     result = decoded.get("result") if isinstance(decoded, dict) else decoded
     snippets, sources = _autorag_normalize_result(result if isinstance(result, dict) else {"result": result})
-    if os.getenv("DEBUG_OPENAI_RESPONSES") == "1":
+    if semantic_cache:
+        _SEMANTIC_RESPONSE_CACHE.put_text(query, cache_namespace, (list(snippets), [dict(s) for s in sources]))
+    if _DEBUG_OPENAI:
         try:
             print(
                 "[AUTORAG] ok",
@@ -249,30 +576,124 @@ def _call_autorag_search(configurable: Configuration, query: str) -> tuple[list[
     return snippets, sources
 
 
+def _call_autorag_search_batch(
+    configurable: Configuration, queries: list[str]
+) -> list[tuple[list[str], list[dict]]]:
+    """Post several AutoRAG queries in one request against the Worker batch endpoint.
+
+    Sends {"ragId", "queries"} to `<endpoint>/batch` and expects
+    {"results": [<per-query result>, ...]}. Falls back to per-query
+    _call_autorag_search calls if the Worker does not expose the batch route,
+    so callers can use this unconditionally.
+    """
+    endpoint = (configurable.autorag_endpoint or "").strip()
+    rag_id = (configurable.autorag_id or "").strip()
+    deduped = [q for q in dict.fromkeys(q.strip() for q in queries) if q]
+    if not endpoint or not rag_id or not deduped:
+        return [([], []) for _ in queries]
+    if len(deduped) == 1:
+        by_query = {deduped[0]: _call_autorag_search(configurable, deduped[0])}
+        return [by_query.get(q.strip(), ([], [])) for q in queries]
+
+    headers = {}
+    if _INTERNAL_API_SECRET:
+        headers["x-internal-secret"] = _INTERNAL_API_SECRET
+    results: list | None = None
+    try:
+        resp = _autorag_post(endpoint.rstrip("/") + "/batch", {"ragId": rag_id, "queries": deduped}, headers)
+        if resp.status_code < 400:
+            decoded = _json_loads(resp.content)
+            raw = decoded.get("results") if isinstance(decoded, dict) else None
+            if isinstance(raw, list) and len(raw) == len(deduped):
+                results = raw
+    except Exception:
+        results = None
+    if results is None:
+        # Worker without /batch support (or transport error): one request per query.
+        by_query = {q: _call_autorag_search(configurable, q) for q in deduped}
+        return [by_query.get(q.strip(), ([], [])) for q in queries]
+
+    by_query = {}
+    for q, item in zip(deduped, results):
+        result = item.get("result") if isinstance(item, dict) and "result" in item else item
+        by_query[q] = _autorag_normalize_result(result if isinstance(result, dict) else {"result": result})
+    return [by_query.get(q.strip(), ([], [])) for q in queries]
+
+
 def require_gemini_key() -> None:
     """Ensure GEMINI_API_KEY is available before using Gemini models."""
     if os.getenv("GEMINI_API_KEY") is None:
         raise ValueError("GEMINI_API_KEY is not set; required for Gemini-based steps.")
 
 
+# Singleton API clients: each SDK client owns an httpx connection pool, and
+# re-creating it per call throws away warm TLS connections (DNS + handshake on
+# every request). Built lazily so import never requires credentials.
+_GENAI_CLIENT: Client | None = None
+_OPENAI_CLIENT: OpenAI | None = None
+_ASYNC_OPENAI_CLIENT: AsyncOpenAI | None = None
+
+
+def _openai_http_limits() -> httpx.Limits:
+    return httpx.Limits(max_keepalive_connections=20, max_connections=40)
+
+
 def get_genai_client() -> Client:
-    """Create a Gemini client when needed to avoid import-time failures."""
-    require_gemini_key()
-    return Client(api_key=os.getenv("GEMINI_API_KEY"))
+    """Return the shared Gemini client, created on first use."""
+    global _GENAI_CLIENT
+    if _GENAI_CLIENT is None:
+        require_gemini_key()
+        _GENAI_CLIENT = Client(api_key=os.getenv("GEMINI_API_KEY"))
+    return _GENAI_CLIENT
 
 
 def get_openai_client() -> OpenAI:
-    """Return an OpenAI client configured with optional custom base URL."""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if api_key is None:
-        raise ValueError("OPENAI_API_KEY is not set; required for OpenAI-based steps.")
-    base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-    return OpenAI(api_key=api_key, base_url=base_url)
+    """Return the shared OpenAI client configured with optional custom base URL."""
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if api_key is None:
+            raise ValueError("OPENAI_API_KEY is not set; required for OpenAI-based steps.")
+        _OPENAI_CLIENT = OpenAI(
+            api_key=api_key,
+            base_url=_OPENAI_BASE_URL,
+            http_client=httpx.Client(
+                limits=_openai_http_limits(),
+                timeout=httpx.Timeout(60.0, connect=5.0),
+            ),
+        )
+    return _OPENAI_CLIENT
+
+
+def get_async_openai_client() -> AsyncOpenAI:
+    """Return the shared AsyncOpenAI client for concurrent structured calls."""
+    global _ASYNC_OPENAI_CLIENT
+    if _ASYNC_OPENAI_CLIENT is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if api_key is None:
+            raise ValueError("OPENAI_API_KEY is not set; required for OpenAI-based steps.")
+        _ASYNC_OPENAI_CLIENT = AsyncOpenAI(
+            api_key=api_key,
+            base_url=_OPENAI_BASE_URL,
+            http_client=httpx.AsyncClient(
+                limits=_openai_http_limits(),
+                timeout=httpx.Timeout(60.0, connect=5.0),
+            ),
+        )
+    return _ASYNC_OPENAI_CLIENT
+
+
+def reset_api_clients() -> None:
+    """Drop the cached API clients (tests / credential rotation)."""
+    global _GENAI_CLIENT, _OPENAI_CLIENT, _ASYNC_OPENAI_CLIENT
+    _GENAI_CLIENT = None
+    _OPENAI_CLIENT = None
+    _ASYNC_OPENAI_CLIENT = None
 
 
 def debug_openai_response(prefix: str, response) -> None:
     """Print limited OpenAI response info when DEBUG_OPENAI_RESPONSES=1."""
-    if os.getenv("DEBUG_OPENAI_RESPONSES") != "1":
+    if not _DEBUG_OPENAI:
         return
     try:
         print(f"[DEBUG_OPENAI] {prefix} raw={response!r}")
@@ -280,11 +701,26 @@ def debug_openai_response(prefix: str, response) -> None:
         print(f"[DEBUG_OPENAI] {prefix} debug error: {exc}")
 
 
+_ERROR_DETAIL_ATTRS = ("status_code", "code", "param", "type", "request_id")
+# Which of the detail attrs each exception class actually carries, probed on
+# first sight so repeated errors (e.g. 429 storms) skip the absent ones.
+_ERROR_ATTR_CACHE: dict[type, tuple[str, ...]] = {}
+
+
+def _error_attrs_for(exc: Exception) -> tuple[str, ...]:
+    cls = type(exc)
+    attrs = _ERROR_ATTR_CACHE.get(cls)
+    if attrs is None:
+        attrs = tuple(a for a in _ERROR_DETAIL_ATTRS if hasattr(exc, a))
+        _ERROR_ATTR_CACHE[cls] = attrs
+    return attrs
+
+
 def _format_openai_error(exc: Exception) -> dict:
     """Best-effort extraction of actionable OpenAI error details (safe for logs)."""
     payload: dict = {"type": exc.__class__.__name__}
     payload["message"] = str(exc)
-    for attr in ("status_code", "code", "param", "type", "request_id"):
+    for attr in _error_attrs_for(exc):
         val = getattr(exc, attr, None)
         if val is not None:
             payload[attr] = val
@@ -334,7 +770,7 @@ def _summarize_openai_error(payload: dict) -> str:
 
 def debug_openai_error(prefix: str, exc: Exception) -> None:
     """Print OpenAI error details when DEBUG_OPENAI_RESPONSES=1."""
-    if os.getenv("DEBUG_OPENAI_RESPONSES") != "1":
+    if not _DEBUG_OPENAI:
         return
     try:
         print(f"[DEBUG_OPENAI_ERROR] {prefix} {_format_openai_error(exc)}")
@@ -344,17 +780,21 @@ def debug_openai_error(prefix: str, exc: Exception) -> None:
 
 def _fallback_text_from_tool_calls(tool_calls: list[dict]) -> str:
     """Generate a short user-facing confirmation when the model returned only tool calls."""
-    creates = [c for c in tool_calls if c.get("name") == "createNode"]
-    updates = [c for c in tool_calls if c.get("name") == "updateNode"]
-    connects = [c for c in tool_calls if c.get("name") == "connectNodes"]
-    runs = [c for c in tool_calls if c.get("name") == "runNode"]
-
+    creates = updates = connects = runs = 0
     labels: list[str] = []
-    for c in creates:
-        args = c.get("arguments") or {}
-        label = args.get("label")
-        if isinstance(label, str) and label.strip():
-            labels.append(label.strip())
+    for c in tool_calls:
+        name = c.get("name")
+        if name == "createNode":
+            creates += 1
+            label = (c.get("arguments") or {}).get("label")
+            if isinstance(label, str) and label.strip():
+                labels.append(label.strip())
+        elif name == "updateNode":
+            updates += 1
+        elif name == "connectNodes":
+            connects += 1
+        elif name == "runNode":
+            runs += 1
 
     parts: list[str] = []
     if creates:
@@ -363,291 +803,417 @@ def _fallback_text_from_tool_calls(tool_calls: list[dict]) -> str:
             tail = "…" if len(labels) > 3 else ""
             parts.append(f"已在画布创建节点：{head}{tail}")
         else:
-            parts.append(f"已在画布创建 {len(creates)} 个节点")
+            parts.append(f"已在画布创建 {creates} 个节点")
     if updates:
-        parts.append(f"已更新 {len(updates)} 个节点")
+        parts.append(f"已更新 {updates} 个节点")
     if connects:
-        parts.append(f"已连接 {len(connects)} 条连线")
+        parts.append(f"已连接 {connects} 条连线")
     if runs:
-        parts.append(f"已触发运行 {len(runs)} 个节点")
+        parts.append(f"已触发运行 {runs} 个节点")
 
     if not parts:
         return "已更新画布。"
     return "；".join(parts) + "。"
 
 
+_COMPOSEVIDEO_HDR_TITLE = "10–15秒分镜视频提示词（分镜清单 + 镜头语言）"
+_COMPOSEVIDEO_HDR_CHARS = "角色（保持与画布设定一致）："
+_COMPOSEVIDEO_HDR_SHOTS = "分镜（逐镜头）："
+
+
+def _s(d: dict, *keys: str) -> str:
+    """Return the first non-blank string value of `keys` in `d`, stripped."""
+    for k in keys:
+        v = d.get(k)
+        if isinstance(v, str) and v.strip():
+            return v.strip()
+    return ""
+
+
 def _composevideo_prompt_from_structured_config(cfg: dict) -> str:
     """Coerce a structured storyboard config into a single prompt string."""
-    duration = cfg.get("durationSeconds") or cfg.get("duration") or cfg.get("duration_sec")
+    duration = _first(cfg, _DURATION_KEYS)
     fps = cfg.get("fps")
-    aspect = cfg.get("aspectRatio") or cfg.get("aspect") or cfg.get("ratio")
-    style = cfg.get("style") or cfg.get("visualStyle") or cfg.get("look")
-    music = cfg.get("musicSfx") or cfg.get("music") or cfg.get("sfx")
+    aspect = _s(cfg, *_ASPECT_KEYS)
+    style = _s(cfg, *_STYLE_KEYS)
+    music = _s(cfg, *_MUSIC_KEYS)
     characters = cfg.get("characters") if isinstance(cfg.get("characters"), list) else []
     shots = cfg.get("shots") if isinstance(cfg.get("shots"), list) else []
 
-    parts: list[str] = []
-    parts.append("10–15秒分镜视频提示词（分镜清单 + 镜头语言）")
+    parts: list[str] = [_COMPOSEVIDEO_HDR_TITLE]
+    parts_append = parts.append
     meta_bits: list[str] = []
     if isinstance(duration, (int, float)):
         meta_bits.append(f"时长: {duration}s")
     if isinstance(fps, (int, float)):
         meta_bits.append(f"FPS: {int(fps)}")
-    if isinstance(aspect, str) and aspect.strip():
-        meta_bits.append(f"画幅: {aspect.strip()}")
+    if aspect:
+        meta_bits.append(f"画幅: {aspect}")
     if meta_bits:
-        parts.append(" / ".join(meta_bits))
-    if isinstance(style, str) and style.strip():
-        parts.append(f"风格基准: {style.strip()}")
-    if isinstance(music, str) and music.strip():
-        parts.append(f"音乐/音效: {music.strip()}")
+        parts_append(" / ".join(meta_bits))
+    if style:
+        parts_append(f"风格基准: {style}")
+    if music:
+        parts_append(f"音乐/音效: {music}")
 
     if characters:
-        parts.append("")
-        parts.append("角色（保持与画布设定一致）：")
+        parts_append("")
+        parts_append(_COMPOSEVIDEO_HDR_CHARS)
         for c in characters:
             if not isinstance(c, dict):
                 continue
-            ref = c.get("ref") or c.get("label") or c.get("nodeId")
-            name = c.get("name")
-            notes = c.get("notes")
+            ref = _s(c, *_CHAR_REF_KEYS)
+            name = _s(c, "name")
+            notes = _s(c, "notes")
             line = "- "
-            if isinstance(name, str) and name.strip():
-                line += name.strip()
-            if isinstance(ref, str) and ref.strip():
-                line += f"（参考: {ref.strip()}）" if line.strip() != "-" else ref.strip()
-            if isinstance(notes, str) and notes.strip():
-                line += f"：{notes.strip()}"
+            if name:
+                line += name
+            if ref:
+                line += f"（参考: {ref}）" if line.strip() != "-" else ref
+            if notes:
+                line += f"：{notes}"
             if line.strip() != "-":
-                parts.append(line)
+                parts_append(line)
 
     if shots:
-        parts.append("")
-        parts.append("分镜（逐镜头）：")
-        for idx, s in enumerate(shots, start=1):
-            if not isinstance(s, dict):
+        parts_append("")
+        parts_append(_COMPOSEVIDEO_HDR_SHOTS)
+        for idx, shot in enumerate(shots, start=1):
+            if not isinstance(shot, dict):
                 continue
-            sid = s.get("id") or f"S{idx}"
-            time_range = s.get("time")
-            shot_size = s.get("shotSize")
-            camera = s.get("camera")
-            movement = s.get("movement")
-            action = s.get("action")
-            composition = s.get("composition")
-            seg: list[str] = []
-            header = f"{sid}"
-            if isinstance(time_range, str) and time_range.strip():
-                header += f"（{time_range.strip()}）"
-            seg.append(header)
-            if isinstance(shot_size, str) and shot_size.strip():
-                seg.append(f"景别: {shot_size.strip()}")
-            if isinstance(camera, str) and camera.strip():
-                seg.append(f"机位/镜头: {camera.strip()}")
-            if isinstance(movement, str) and movement.strip():
-                seg.append(f"运动: {movement.strip()}")
-            if isinstance(action, str) and action.strip():
-                seg.append(f"内容: {action.strip()}")
-            if isinstance(composition, str) and composition.strip():
-                seg.append(f"构图: {composition.strip()}")
-            parts.append("- " + "；".join(seg))
+            sid = shot.get("id") or f"S{idx}"
+            time_range = _s(shot, "time")
+            seg: list[str] = [f"{sid}（{time_range}）" if time_range else f"{sid}"]
+            if shot_size := _s(shot, "shotSize"):
+                seg.append(f"景别: {shot_size}")
+            if camera := _s(shot, "camera"):
+                seg.append(f"机位/镜头: {camera}")
+            if movement := _s(shot, "movement"):
+                seg.append(f"运动: {movement}")
+            if action := _s(shot, "action"):
+                seg.append(f"内容: {action}")
+            if composition := _s(shot, "composition"):
+                seg.append(f"构图: {composition}")
+            parts_append("- " + "；".join(seg))
 
     # If nothing useful, fall back to any existing freeform prompt keys.
-    out = "\n".join([p for p in parts if isinstance(p, str)]).strip()
+    out = "\n".join(parts).strip()
     if out:
         return out
-    for key in ("prompt", "videoPrompt", "storyboard"):
-        val = cfg.get(key)
-        if isinstance(val, str) and val.strip():
-            return val.strip()
-    return ""
+    return _s(cfg, "prompt", "videoPrompt", "storyboard")
 
 
-def _collect_stream_text(stream) -> str:
-    """Collect text from streaming Responses API iterator."""
-    parts: list[str] = []
+# Streaming event dispatch: the collectors run once per streamed chunk (thousands per
+# response), so known event types route through a dict lookup instead of repeated
+# getattr/substring probes. Unknown event names still fall back to the generic probes.
+def _h_text_delta(chunk, buf: io.StringIO) -> None:
+    """Write the text payload of an output_text.delta event."""
+    delta = getattr(chunk, "delta", None)
+    if delta:
+        buf.write(delta if isinstance(delta, str) else str(delta))
+        return
+    data = getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
+    if data:
+        buf.write(data if isinstance(data, str) else str(data))
+
+
+def _h_text_done(chunk, buf: io.StringIO) -> None:
+    """Write the full text payload of an output_text done/summary event."""
+    text = getattr(chunk, "output_text", None)
+    if text:
+        buf.write(text if isinstance(text, str) else str(text))
+
+
+_TEXT_STREAM_HANDLERS = {
+    "response.output_text.delta": _h_text_delta,
+    "response.output_text.done": _h_text_done,
+}
+
+
+def _h_tool_item(chunk, tool_calls_by_id: dict, alias_to_call_id: dict) -> None:
+    """Register a function_call output item (added/done events)."""
+    item = getattr(chunk, "item", None)
+    if getattr(item, "type", None) != "function_call":
+        return
+    call_id = getattr(item, "call_id", None)
+    item_id = getattr(item, "id", None)
+    name = getattr(item, "name", None)
+    arguments = getattr(item, "arguments", "") or ""
+    if not call_id:
+        return
+    alias_to_call_id[call_id] = call_id
+    if item_id:
+        alias_to_call_id[item_id] = call_id
+    record = tool_calls_by_id.get(call_id) or {
+        "id": call_id,
+        "name": name,
+        "arguments": "",
+    }
+    # name can arrive early; arguments may be partial and updated by delta/done events
+    if name:
+        record["name"] = name
+    if isinstance(arguments, str) and arguments:
+        record["arguments"] = arguments
+    tool_calls_by_id[call_id] = record
+
+
+def _h_tool_args_delta(chunk, tool_calls_by_id: dict, alias_to_call_id: dict) -> None:
+    """Accumulate streamed function-call argument deltas."""
+    item_id = getattr(chunk, "item_id", None)
+    delta = getattr(chunk, "delta", "") or ""
+    if not item_id or not isinstance(delta, str):
+        return
+    call_id = alias_to_call_id.get(item_id, item_id)
+    record = tool_calls_by_id.get(call_id)
+    if record is None:
+        record = {"id": call_id, "name": None, "arguments": ""}
+        tool_calls_by_id[call_id] = record
+    # Deltas go into a per-record buffer; joining per delta would be quadratic.
+    argbuf = record.get("_argbuf")
+    if argbuf is None:
+        argbuf = record["_argbuf"] = io.StringIO()
+        record["_tracker"] = _JsonBalanceTracker()
+        if record.get("arguments"):
+            argbuf.write(record["arguments"])
+            record["_tracker"].feed(record["arguments"])
+    argbuf.write(delta)
+    # Eager parse: once the argument object closes, decode it while the rest of
+    # the stream is still arriving (and fail fast on malformed output).
+    tracker = record.get("_tracker")
+    if tracker is not None and tracker.feed(delta):
+        record["_tracker"] = None
+        raw = argbuf.getvalue()
+        try:
+            record["_parsed_args"] = _json_loads(raw)
+            record["_parsed_src"] = raw
+        except Exception:
+            pass
+
+
+def _h_tool_args_done(chunk, tool_calls_by_id: dict, alias_to_call_id: dict) -> None:
+    """Store the final function-call argument payload."""
+    item_id = getattr(chunk, "item_id", None)
+    arguments = getattr(chunk, "arguments", "") or ""
+    if not item_id or not isinstance(arguments, str):
+        return
+    call_id = alias_to_call_id.get(item_id, item_id)
+    record = tool_calls_by_id.get(call_id)
+    if record is None:
+        record = {"id": call_id, "name": None, "arguments": ""}
+        tool_calls_by_id[call_id] = record
+    record["arguments"] = arguments
+    record.pop("_argbuf", None)
+    record.pop("_tracker", None)
+
+
+_TOOL_STREAM_HANDLERS = {
+    "response.output_item.added": _h_tool_item,
+    "response.output_item.done": _h_tool_item,
+    "response.function_call_arguments.delta": _h_tool_args_delta,
+    "response.function_call_arguments.done": _h_tool_args_done,
+}
+
+
+def _collect_generic_chunk(chunk, buf: io.StringIO) -> None:
+    """Handle chat.completions-style chunks and dict fallbacks."""
+    choice = getattr(chunk, "choices", None)
+    if choice:
+        choice = choice[0]
+        delta = getattr(choice, "delta", None) or {}
+        content = delta.get("content")
+        if isinstance(content, str):
+            buf.write(content)
+        elif isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict) and block.get("text"):
+                    buf.write(block["text"])
+                elif isinstance(block, str):
+                    buf.write(block)
+                elif hasattr(block, "text") and getattr(block, "text"):
+                    buf.write(getattr(block, "text"))
+        return
+    if isinstance(chunk, dict):
+        if "delta" in chunk:
+            buf.write(str(chunk["delta"]))
+            return
+        if "output_text" in chunk:
+            buf.write(str(chunk["output_text"]))
+            return
+        data = chunk.get("data")
+        if isinstance(data, dict):
+            if "delta" in data:
+                buf.write(str(data["delta"]))
+            elif "output_text" in data:
+                buf.write(str(data["output_text"]))
+
+
+class _JsonBalanceTracker:
+    """Track brace/bracket balance across streamed text to spot a complete JSON value.
+
+    Structured-output responses carry exactly one top-level object; once it
+    closes, the rest of the stream is dead air we can skip.
+    """
+
+    __slots__ = ("depth", "started", "in_string", "escape")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text: str) -> bool:
+        """Consume a delta; return True when the top-level JSON value has closed."""
+        for ch in text:
+            if self.escape:
+                self.escape = False
+                continue
+            if self.in_string:
+                if ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = True
+            elif ch == "{" or ch == "[":
+                self.depth += 1
+                self.started = True
+            elif ch == "}" or ch == "]":
+                self.depth -= 1
+                if self.started and self.depth <= 0:
+                    return True
+        return False
+
+
+def _collect_stream_text(stream, early_stop_on_complete_json: bool = False) -> str:
+    """Collect text from streaming Responses API iterator.
+
+    With early_stop_on_complete_json=True the stream is closed as soon as the
+    streamed text forms a balanced top-level JSON value, skipping trailing
+    bookkeeping events.
+    """
+    buf = io.StringIO()
+    debug = _DEBUG_OPENAI
+    tracker = _JsonBalanceTracker() if early_stop_on_complete_json else None
     try:
         for chunk in stream:
-            if os.getenv("DEBUG_OPENAI_RESPONSES") == "1":
+            if debug:
                 try:
                     print(f"[DEBUG_OPENAI_STREAM] {chunk!r}")
                 except Exception:
                     pass
-            # Responses API streaming events
             ev_type = getattr(chunk, "type", None)
-            if ev_type and isinstance(ev_type, str) and "output_text.delta" in ev_type:
-                delta = getattr(chunk, "delta", None)
-                if delta:
-                    parts.append(str(delta))
-                    continue
-                data = getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
-                if data:
-                    parts.append(str(data))
-                    continue
-            if ev_type and isinstance(ev_type, str) and "response.output_text" in ev_type:
-                text = getattr(chunk, "output_text", None)
-                if text:
-                    parts.append(str(text))
+            if isinstance(ev_type, str):
+                handler = _TEXT_STREAM_HANDLERS.get(ev_type)
+                if handler is not None:
+                    handler(chunk, buf)
+                    if tracker is not None and ev_type == "response.output_text.delta":
+                        delta = getattr(chunk, "delta", None)
+                        if isinstance(delta, str) and tracker.feed(delta):
+                            _close_stream(stream)
+                            break
                     continue
-            # chat.completions stream (not used now but kept)
-            choice = getattr(chunk, "choices", None)
-            if choice:
-                choice = choice[0]
-                delta = getattr(choice, "delta", None) or {}
-                content = delta.get("content")
-                if isinstance(content, str):
-                    parts.append(content)
-                elif isinstance(content, list):
-                    for block in content:
-                        if isinstance(block, dict) and block.get("text"):
-                            parts.append(block["text"])
-                        elif isinstance(block, str):
-                            parts.append(block)
-                        elif hasattr(block, "text") and getattr(block, "text"):
-                            parts.append(getattr(block, "text"))
-                continue
-            # Dict fallback
-            if isinstance(chunk, dict):
-                if "delta" in chunk:
-                    parts.append(str(chunk["delta"]))
+                # Unknown/vendor-specific event names: keep the substring probes.
+                if "output_text.delta" in ev_type:
+                    _h_text_delta(chunk, buf)
                     continue
-                if "output_text" in chunk:
-                    parts.append(str(chunk["output_text"]))
+                if "response.output_text" in ev_type:
+                    _h_text_done(chunk, buf)
                     continue
-                data = chunk.get("data")
-                if isinstance(data, dict):
-                    if "delta" in data:
-                        parts.append(str(data["delta"]))
-                        continue
-                    if "output_text" in data:
-                        parts.append(str(data["output_text"]))
-                        continue
+            _collect_generic_chunk(chunk, buf)
     except Exception:
         pass
-    return "".join(parts)
+    return buf.getvalue()
+
+
+def _close_stream(stream) -> None:
+    """Best-effort close of a streaming response iterator."""
+    close = getattr(stream, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception:
+            pass
 
 
 def _collect_stream_text_and_tools(stream) -> tuple[str, list[dict]]:
     """Collect text and any tool calls from streaming Responses API iterator."""
-    parts: list[str] = []
+    buf = io.StringIO()
     tool_calls_by_id: dict[str, dict] = {}
     alias_to_call_id: dict[str, str] = {}
     try:
         for chunk in stream:
-            # tool calls (Responses API streaming events)
             ev_type = getattr(chunk, "type", None)
-            if ev_type == "response.output_item.added" or ev_type == "response.output_item.done":
-                item = getattr(chunk, "item", None)
-                if getattr(item, "type", None) == "function_call":
-                    call_id = getattr(item, "call_id", None)
-                    item_id = getattr(item, "id", None)
-                    name = getattr(item, "name", None)
-                    arguments = getattr(item, "arguments", "") or ""
-                    if call_id:
-                        alias_to_call_id[call_id] = call_id
-                        if item_id:
-                            alias_to_call_id[item_id] = call_id
-                        record = tool_calls_by_id.get(call_id) or {
-                            "id": call_id,
-                            "name": name,
-                            "arguments": "",
-                        }
-                        # name can arrive early; arguments may be partial and updated by delta/done events
-                        if name:
-                            record["name"] = name
-                        if isinstance(arguments, str) and arguments:
-                            record["arguments"] = arguments
-                        tool_calls_by_id[call_id] = record
-            elif ev_type == "response.function_call_arguments.delta":
-                item_id = getattr(chunk, "item_id", None)
-                delta = getattr(chunk, "delta", "") or ""
-                if item_id and isinstance(delta, str):
-                    call_id = alias_to_call_id.get(item_id, item_id)
-                    record = tool_calls_by_id.get(call_id) or {
-                        "id": call_id,
-                        "name": None,
-                        "arguments": "",
-                    }
-                    record["arguments"] = (record.get("arguments") or "") + delta
-                    tool_calls_by_id[call_id] = record
-            elif ev_type == "response.function_call_arguments.done":
-                item_id = getattr(chunk, "item_id", None)
-                arguments = getattr(chunk, "arguments", "") or ""
-                if item_id and isinstance(arguments, str):
-                    call_id = alias_to_call_id.get(item_id, item_id)
-                    record = tool_calls_by_id.get(call_id) or {
-                        "id": call_id,
-                        "name": None,
-                        "arguments": "",
-                    }
-                    record["arguments"] = arguments
-                    tool_calls_by_id[call_id] = record
-
-            # text
-            if ev_type and isinstance(ev_type, str) and "output_text.delta" in ev_type:
-                delta = getattr(chunk, "delta", None)
-                if delta:
-                    parts.append(str(delta))
-                    continue
-                data = getattr(chunk, "data", None) or getattr(chunk, "output_text", None)
-                if data:
-                    parts.append(str(data))
+            if isinstance(ev_type, str):
+                # tool calls (Responses API streaming events)
+                tool_handler = _TOOL_STREAM_HANDLERS.get(ev_type)
+                if tool_handler is not None:
+                    tool_handler(chunk, tool_calls_by_id, alias_to_call_id)
                     continue
-            if ev_type and isinstance(ev_type, str) and "response.output_text" in ev_type:
-                text = getattr(chunk, "output_text", None)
-                if text:
-                    parts.append(str(text))
+                # text
+                text_handler = _TEXT_STREAM_HANDLERS.get(ev_type)
+                if text_handler is not None:
+                    text_handler(chunk, buf)
                     continue
-            choice = getattr(chunk, "choices", None)
-            if choice:
-                choice = choice[0]
-                delta = getattr(choice, "delta", None) or {}
-                content = delta.get("content")
-                if isinstance(content, str):
-                    parts.append(content)
-                elif isinstance(content, list):
-                    for block in content:
-                        if isinstance(block, dict) and block.get("text"):
-                            parts.append(block["text"])
-                        elif isinstance(block, str):
-                            parts.append(block)
-                        elif hasattr(block, "text") and getattr(block, "text"):
-                            parts.append(getattr(block, "text"))
-                continue
-            if isinstance(chunk, dict):
-                if "delta" in chunk:
-                    parts.append(str(chunk["delta"]))
+                if "output_text.delta" in ev_type:
+                    _h_text_delta(chunk, buf)
                     continue
-                if "output_text" in chunk:
-                    parts.append(str(chunk["output_text"]))
+                if "response.output_text" in ev_type:
+                    _h_text_done(chunk, buf)
                     continue
-                data = chunk.get("data")
-                if isinstance(data, dict):
-                    if "delta" in data:
-                        parts.append(str(data["delta"]))
-                        continue
-                    if "output_text" in data:
-                        parts.append(str(data["output_text"]))
-                        continue
+            _collect_generic_chunk(chunk, buf)
     except Exception:
         pass
+    return buf.getvalue(), _finalize_tool_calls(tool_calls_by_id)
+
+
+def _finalize_tool_calls(tool_calls_by_id: dict) -> list[dict]:
+    """Flush per-record argument buffers and parse argument JSON."""
     tool_calls: list[dict] = []
     for call in tool_calls_by_id.values():
+        argbuf = call.pop("_argbuf", None)
+        call.pop("_tracker", None)
+        if argbuf is not None:
+            call["arguments"] = argbuf.getvalue()
         name = call.get("name")
         if not name:
             continue
         args = call.get("arguments")
         parsed_args = args
         if isinstance(args, str):
-            try:
-                parsed_args = json.loads(args) if args.strip() else {}
-            except Exception:
-                parsed_args = args
+            # Reuse the eagerly parsed value when it matches the final payload.
+            if call.get("_parsed_src") == args:
+                parsed_args = call["_parsed_args"]
+            else:
+                try:
+                    parsed_args = _json_loads(args) if args.strip() else {}
+                except Exception:
+                    parsed_args = args
         tool_calls.append({"id": call.get("id"), "name": name, "arguments": parsed_args})
-    return "".join(parts), tool_calls
+    return tool_calls
 
 
 def _call_openai_structured(model: str, prompt: str, schema_model):
     """Call OpenAI Responses API and parse into Pydantic model."""
+    exact_key: str | None = None
+    if _exact_prompt_cache_enabled():
+        exact_key = _exact_cache_key(model, schema_model.__name__, prompt)
+        cached_text = _exact_cache_get(exact_key)
+        if cached_text is not None:
+            try:
+                return _rebuild_cached(schema_model, cached_text)
+            except Exception:
+                pass
+    semantic_cache = _semantic_cache_enabled()
+    cache_namespace = f"{model}|{schema_model.__name__}"
+    if semantic_cache:
+        cached_text = _SEMANTIC_RESPONSE_CACHE.lookup_text(prompt, cache_namespace)
+        if isinstance(cached_text, str):
+            try:
+                return _rebuild_cached(schema_model, cached_text)
+            except Exception:
+                pass
     client: OpenAI | None = None
     text = ""
     first_exc: Exception | None = None
@@ -662,101 +1228,356 @@ def _call_openai_structured(model: str, prompt: str, schema_model):
         response = client.responses.create(
             model=model,
             input=[{"role": "user", "content": [{"type": "input_text", "text": prompt}]}],
-            text={
-                "format": {
-                    "type": "json_schema",
-                    "name": schema_model.__name__,
-                    "schema": schema_model.model_json_schema(),
-                    "strict": True,
-                }
-            },
+            text=_structured_text_format(schema_model),
             stream=True,
         )
         debug_openai_response(f"{schema_model.__name__}", response)
-        text = _collect_stream_text(response)
+        text = _collect_stream_text(response, early_stop_on_complete_json=True)
     except Exception as exc:
         first_exc = exc
         debug_openai_error(f"{schema_model.__name__}", exc)
+        text = ""
+    parsed, text = _validate_with_repair(schema_model, text)
+    if parsed is None:
+        return _structured_output_fallback(schema_model, prompt, text, first_exc, None)
+    if exact_key is not None:
+        _exact_cache_put(exact_key, text)
+    if semantic_cache:
+        _SEMANTIC_RESPONSE_CACHE.put_text(prompt, cache_namespace, text)
+    return parsed
+
+
+@functools.lru_cache(maxsize=32)
+def _json_validator(schema_model):
+    """Memoize one compiled pydantic-core JSON validator per schema class.
+
+    TypeAdapter reuses the model's SchemaValidator but skips the BaseModel
+    classmethod wrapper, so hot parse sites pay one cached attribute lookup
+    instead of re-entering the Python dispatch path per LLM response.
+    """
+    return TypeAdapter(schema_model).validate_json
+
+
+def _rebuild_cached(schema_model, cached_text: str):
+    """Rebuild a schema instance from this process's own cached dump.
+
+    Cache values are model_dump_json() output written after a successful
+    validation in this process, and none of the schema classes define custom
+    validators, so model_construct can skip pydantic-core entirely on hits.
+    Anything shape-surprising falls back to the real validator.
+    """
+    data = _json_loads(cached_text)
+    if isinstance(data, dict):
+        return schema_model.model_construct(**data)
+    return _json_validator(schema_model)(cached_text)
+
+
+@functools.lru_cache(maxsize=32)
+def _json_schema_for(schema_model) -> dict:
+    """Memoize Pydantic JSON-schema generation per schema class."""
+    return schema_model.model_json_schema()
+
+
+@functools.lru_cache(maxsize=32)
+def _structured_text_format(schema_model) -> dict:
+    """Memoize the Responses API text.format payload per schema class."""
+    return {
+        "format": {
+            "type": "json_schema",
+            "name": schema_model.__name__,
+            "schema": _json_schema_for(schema_model),
+            "strict": True,
+        }
+    }
+
+
+def _json_repair_candidates(text: str):
+    """Yield cheap local repairs of near-JSON model output (no extra round-trip)."""
+    if not isinstance(text, str) or "{" not in text:
+        return
+    start = text.find("{")
+    end = text.rfind("}")
+    if end > start:
+        yield text[start : end + 1]
+    # Close any unbalanced braces/brackets left by a truncated stream.
+    fragment = text[start:]
+    open_braces = fragment.count("{") - fragment.count("}")
+    open_brackets = fragment.count("[") - fragment.count("]")
+    if open_braces > 0 or open_brackets > 0:
+        yield fragment + "]" * max(open_brackets, 0) + "}" * max(open_braces, 0)
+
+
+def _validate_with_repair(schema_model, text: str):
+    """Validate model output, retrying locally repaired variants on failure.
+
+    Returns (parsed_or_None, text_that_validated_or_original).
+    """
+    try:
+        return _json_validator(schema_model)(text), text
+    except Exception:
+        pass
+    for candidate in _json_repair_candidates(text):
         try:
-            if client is None:
-                raise first_exc or ValueError("OpenAI client is unavailable.")
-            response = client.responses.create(
-                model=model,
-                input=[{"role": "user", "content": [{"type": "input_text", "text": prompt}]}],
-                stream=True,
-            )
-            debug_openai_response(f"{schema_model.__name__}", response)
-            text = _collect_stream_text(response)
-        except Exception as exc2:
-            debug_openai_error(f"{schema_model.__name__} fallback", exc2)
-            text = ""
+            return _json_validator(schema_model)(candidate), candidate
+        except Exception:
+            continue
+    return None, text
+
+
+@functools.lru_cache(maxsize=1)
+def _role_token_pattern():
+    """Precompiled alternation of role ids/names for fallback role extraction.
+
+    Returns (compiled_regex, token -> role_id map). Longer tokens first so a
+    role name wins over an id that happens to be its substring.
+    """
+    token_to_rid: dict[str, str] = {}
+    for rid, role in role_map().items():
+        token_to_rid[rid.lower()] = rid
+        name = str(role.get("name", "")).strip().lower()
+        if name:
+            token_to_rid[name] = rid
+    tokens = sorted(token_to_rid, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(t) for t in tokens), re.IGNORECASE)
+    return pattern, token_to_rid
+
+
+def _structured_output_fallback(schema_model, prompt: str, text: str, first_exc: Exception | None, exc: Exception | None):
+    """Build a minimal valid payload when the provider ignored the JSON schema."""
+    if schema_model.__name__ == "SearchQueryList":
+        rationale = "Fallback from unparseable model output."
+        if first_exc is not None and not text:
+            rationale = f"Fallback due to OpenAI error: {_format_openai_error(first_exc).get('message', '')}"
+        return schema_model(query=[prompt], rationale=rationale)
+    if schema_model.__name__ == "Reflection":
+        # This node is unused in the current (no web research) graph, but keep a safe default.
+        return schema_model(
+            is_sufficient=True, knowledge_gap="", follow_up_queries=[]
+        )
+    if schema_model.__name__ == "RoleDecision":
+        raw = (text or "").strip()
+        mapping = role_map()
+        pattern, token_to_rid = _role_token_pattern()
+        match = pattern.search(raw)
+        chosen_id = token_to_rid.get(match.group(0).lower()) if match else None
+        resolved_id = normalize_role_id(chosen_id or DEFAULT_ROLE_ID)
+        profile = mapping.get(resolved_id, mapping[DEFAULT_ROLE_ID])
+        reason = f"Fallback parse from model output: {raw[:120] or '无理由'}"
+        if first_exc is not None and not raw:
+            reason = f"Fallback due to OpenAI error: {_format_openai_error(first_exc).get('message', '')}"
+        return schema_model(
+            role_id=resolved_id,
+            role_name=profile["name"],
+            reason=reason,
+        )
+    raise ValueError(f"Failed to parse model output as {schema_model.__name__}: {text}") from exc
+
+
+async def _acollect_stream_text(stream, early_stop_on_complete_json: bool = False) -> str:
+    """Async mirror of _collect_stream_text for AsyncOpenAI streams.
+
+    Iterating with `async for` yields to the event loop between chunks, so
+    other coroutines (e.g. concurrent AutoRAG calls) can run while tokens
+    trickle in.
+    """
+    buf = io.StringIO()
+    debug = _DEBUG_OPENAI
+    tracker = _JsonBalanceTracker() if early_stop_on_complete_json else None
     try:
-        return schema_model.model_validate_json(text)
-    except Exception as exc:
-        # Fallback: if provider ignores JSON format, try to construct minimal valid payload
-        if schema_model.__name__ == "SearchQueryList":
-            rationale = "Fallback from unparseable model output."
-            if first_exc is not None and not text:
-                rationale = f"Fallback due to OpenAI error: {_format_openai_error(first_exc).get('message', '')}"
-            return schema_model(query=[prompt], rationale=rationale)
-        if schema_model.__name__ == "Reflection":
-            # This node is unused in the current (no web research) graph, but keep a safe default.
-            return schema_model(
-                is_sufficient=True, knowledge_gap="", follow_up_queries=[]
-            )
-        if schema_model.__name__ == "RoleDecision":
-            raw = (text or "").strip()
-            mapping = role_map()
-            chosen_id = None
-            raw_lower = raw.lower()
-            for rid, role in mapping.items():
-                if rid in raw_lower or role["name"].lower() in raw_lower:
-                    chosen_id = rid
-                    break
-            resolved_id = normalize_role_id(chosen_id or DEFAULT_ROLE_ID)
-            profile = mapping.get(resolved_id, mapping[DEFAULT_ROLE_ID])
-            reason = f"Fallback parse from model output: {raw[:120] or '无理由'}"
-            if first_exc is not None and not raw:
-                reason = f"Fallback due to OpenAI error: {_format_openai_error(first_exc).get('message', '')}"
-            return schema_model(
-                role_id=resolved_id,
-                role_name=profile["name"],
-                reason=reason,
-            )
-        raise ValueError(f"Failed to parse model output as {schema_model.__name__}: {text}") from exc
+        async for chunk in stream:
+            if debug:
+                try:
+                    print(f"[DEBUG_OPENAI_STREAM] {chunk!r}")
+                except Exception:
+                    pass
+            ev_type = getattr(chunk, "type", None)
+            if isinstance(ev_type, str):
+                handler = _TEXT_STREAM_HANDLERS.get(ev_type)
+                if handler is not None:
+                    handler(chunk, buf)
+                    if tracker is not None and ev_type == "response.output_text.delta":
+                        delta = getattr(chunk, "delta", None)
+                        if isinstance(delta, str) and tracker.feed(delta):
+                            await _aclose_stream(stream)
+                            break
+                    continue
+                if "output_text.delta" in ev_type:
+                    _h_text_delta(chunk, buf)
+                    continue
+                if "response.output_text" in ev_type:
+                    _h_text_done(chunk, buf)
+                    continue
+            _collect_generic_chunk(chunk, buf)
+    except Exception:
+        pass
+    return buf.getvalue()
 
 
-def _extract_openai_text(response) -> str:
-    """Best-effort text extraction from OpenAI responses API."""
+async def _aclose_stream(stream) -> None:
+    """Best-effort close of an async streaming response iterator."""
+    close = getattr(stream, "close", None)
+    if close is None:
+        return
     try:
-        if getattr(response, "output_text", None):
-            return response.output_text
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
     except Exception:
         pass
+
+
+async def _acollect_stream_text_and_tools(stream) -> tuple[str, list[dict]]:
+    """Async mirror of _collect_stream_text_and_tools for AsyncOpenAI streams."""
+    buf = io.StringIO()
+    tool_calls_by_id: dict[str, dict] = {}
+    alias_to_call_id: dict[str, str] = {}
     try:
-        output = getattr(response, "output", None) or []
-        if output:
-            first = output[0]
-            content = getattr(first, "content", None) or []
-            for block in content:
-                text = getattr(block, "text", None)
-                if text:
-                    return text
-                if hasattr(block, "output_text") and getattr(block, "output_text"):
-                    return getattr(block, "output_text")
-                if isinstance(block, dict):
-                    if block.get("text"):
-                        return block["text"]
-                    if block.get("output_text"):
-                        return block["output_text"]
+        async for chunk in stream:
+            ev_type = getattr(chunk, "type", None)
+            if isinstance(ev_type, str):
+                tool_handler = _TOOL_STREAM_HANDLERS.get(ev_type)
+                if tool_handler is not None:
+                    tool_handler(chunk, tool_calls_by_id, alias_to_call_id)
+                    continue
+                text_handler = _TEXT_STREAM_HANDLERS.get(ev_type)
+                if text_handler is not None:
+                    text_handler(chunk, buf)
+                    continue
+                if "output_text.delta" in ev_type:
+                    _h_text_delta(chunk, buf)
+                    continue
+                if "response.output_text" in ev_type:
+                    _h_text_done(chunk, buf)
+                    continue
+            _collect_generic_chunk(chunk, buf)
     except Exception:
         pass
-    return ""
+    return buf.getvalue(), _finalize_tool_calls(tool_calls_by_id)
 
 
+async def _acall_openai_structured(model: str, prompt: str, schema_model):
+    """Async variant of _call_openai_structured, usable with asyncio.gather fan-out."""
+    exact_key: str | None = None
+    if _exact_prompt_cache_enabled():
+        exact_key = _exact_cache_key(model, schema_model.__name__, prompt)
+        cached_text = _exact_cache_get(exact_key)
+        if cached_text is not None:
+            try:
+                return _rebuild_cached(schema_model, cached_text)
+            except Exception:
+                pass
+    client: AsyncOpenAI | None = None
+    text = ""
+    first_exc: Exception | None = None
+    try:
+        client = get_async_openai_client()
+    except Exception as exc:
+        first_exc = exc
+        debug_openai_error(f"{schema_model.__name__} client_init", exc)
+    try:
+        if client is None:
+            raise first_exc or ValueError("OpenAI client is unavailable.")
+        response = await client.responses.create(
+            model=model,
+            input=[{"role": "user", "content": [{"type": "input_text", "text": prompt}]}],
+            text=_structured_text_format(schema_model),
+            stream=True,
+        )
+        debug_openai_response(f"{schema_model.__name__}", response)
+        text = await _acollect_stream_text(response, early_stop_on_complete_json=True)
+    except Exception as exc:
+        first_exc = exc
+        debug_openai_error(f"{schema_model.__name__}", exc)
+        text = ""
+    parsed, text = _validate_with_repair(schema_model, text)
+    if parsed is None:
+        return _structured_output_fallback(schema_model, prompt, text, first_exc, None)
+    if exact_key is not None:
+        _exact_cache_put(exact_key, text)
+    return parsed
+
+
+async def _acall_openai_structured_many(calls: list[tuple[str, str, type]]) -> list:
+    """Fan out several structured calls concurrently; wall time is max(), not sum()."""
+    return await asyncio.gather(
+        *[_acall_openai_structured(model, prompt, schema_model) for model, prompt, schema_model in calls]
+    )
+
+
+async def _acall_autorag_search(configurable: Configuration, query: str) -> tuple[list[str], list[dict]]:
+    """Async variant of _call_autorag_search for concurrent multi-query retrieval."""
+    endpoint = (configurable.autorag_endpoint or "").strip()
+    rag_id = (configurable.autorag_id or "").strip()
+    secret = _INTERNAL_API_SECRET
+    if not endpoint or not rag_id or not query.strip():
+        return [], []
+
+    headers = {}
+    if secret:
+        headers["x-internal-secret"] = secret
+    try:
+        client = _get_autorag_async_http_client()
+        for attempt in range(3):
+            resp = await client.post(endpoint, json={"ragId": rag_id, "query": query}, headers=headers)
+            if resp.status_code in _AUTORAG_RETRY_STATUSES and attempt < 2:
+                await asyncio.sleep(0.3 * (2**attempt))
+                continue
+            break
+        body = resp.content
+    except Exception as exc:
+        return [f"[AutoRAG] 请求失败: {exc}"], []
+    if resp.status_code >= 400:
+        return [f"[AutoRAG] HTTP {resp.status_code}: {resp.text[:2000]}"], []
+
+    try:
+        decoded = _json_loads(body)
+    except Exception:
+        return [f"[AutoRAG] 非 JSON 响应: {resp.text[:2000]}"], []
+
+    result = decoded.get("result") if isinstance(decoded, dict) else decoded
+    return _autorag_normalize_result(result if isinstance(result, dict) else {"result": result})
+
+
+async def _acall_autorag_search_many(configurable: Configuration, queries: list[str]) -> list[tuple[list[str], list[dict]]]:
+    """Run several AutoRAG queries concurrently against the Worker proxy."""
+    return await asyncio.gather(*[_acall_autorag_search(configurable, q) for q in queries])
+
+
+def _extract_openai_text(response) -> str:
+    """Best-effort text extraction from OpenAI responses API."""
+    try:
+        if getattr(response, "output_text", None):
+            return response.output_text
+    except Exception:
+        pass
+    try:
+        output = getattr(response, "output", None) or []
+        if output:
+            first = output[0]
+            content = getattr(first, "content", None) or []
+            for block in content:
+                text = getattr(block, "text", None)
+                if text:
+                    return text
+                if hasattr(block, "output_text") and getattr(block, "output_text"):
+                    return getattr(block, "output_text")
+                if isinstance(block, dict):
+                    if block.get("text"):
+                        return block["text"]
+                    if block.get("output_text"):
+                        return block["output_text"]
+    except Exception:
+        pass
+    return ""
+
+
+@functools.cache
 def _tool_definitions_for_canvas() -> list[dict]:
     """Expose canvas tools to the LLM for function calling (frontends will execute).
 
+    The definitions are constants, so the list is built once and shared; callers only
+    read or filter it, never mutate.
+
     NOTE: Responses API expects function tools in the flat shape:
     {type: 'function', name, description?, parameters, strict?}
     """
@@ -875,8 +1696,13 @@ def _tool_definitions_for_canvas() -> list[dict]:
     ]
 
 
+@functools.cache
 def _tool_definitions_for_role(role_id: str, allow_canvas_tools: bool) -> list[dict]:
-    """Return tool definitions filtered by role permissions and the decision-layer gate."""
+    """Return tool definitions filtered by role permissions and the decision-layer gate.
+
+    Cached per (role, gate) pair; like the canvas definitions, the returned
+    list is shared and must not be mutated.
+    """
     if not allow_canvas_tools:
         return []
     resolved_id = normalize_role_id(role_id or DEFAULT_ROLE_ID)
@@ -886,6 +1712,194 @@ def _tool_definitions_for_role(role_id: str, allow_canvas_tools: bool) -> list[d
     return [t for t in _tool_definitions_for_canvas() if t.get("name") in allowed]
 
 
+_REF_HANDLES = ("out-image-wide", "in-image-wide")
+
+
+def _make_connect(id_: str, src: str, tgt: str, source_handle: str, target_handle: str) -> dict:
+    """Build a connectNodes tool call (the frontend resolves labels to node ids)."""
+    return {
+        "id": id_,
+        "name": "connectNodes",
+        "arguments": {
+            "sourceNodeId": src,
+            "targetNodeId": tgt,
+            "sourceHandle": source_handle,
+            "targetHandle": target_handle,
+        },
+    }
+
+
+@functools.lru_cache(maxsize=64)
+def _has_ref_intent(text: str) -> bool:
+    """True when the user asks to base new content on existing results.
+
+    Memoized because the same user text is checked again on quick-reply
+    retries within a session.
+    """
+    return _REF_INTENT_RE.search(text) is not None
+
+
+def _filter_image_nodes(canvas_context_obj: dict | None) -> list[tuple[int, str, dict]]:
+    """Successful image-producing canvas nodes with a usable label and image url.
+
+    Shared by the reference pickers so the node list is walked once per turn.
+    """
+    if not isinstance(canvas_context_obj, dict):
+        return []
+    nodes_ctx = canvas_context_obj.get("nodes")
+    if not isinstance(nodes_ctx, list):
+        return []
+    out: list[tuple[int, str, dict]] = []
+    for idx, n in enumerate(nodes_ctx):
+        if not isinstance(n, dict):
+            continue
+        label = n.get("label")
+        if not isinstance(label, str) or not label.strip():
+            continue
+        kind = n.get("kind") or n.get("type")
+        if kind not in _IMAGE_KINDS:
+            continue
+        if n.get("status") != "success":
+            continue
+        image_url = n.get("imageUrl")
+        if not isinstance(image_url, str) or not image_url.strip():
+            continue
+        out.append((idx, label.strip(), n))
+    return out
+
+
+def _pick_reference_image_labels(
+    image_nodes: list[tuple[int, str, dict]], storyboard_label: str
+) -> list[str]:
+    """Pick up to three upstream reference images for a storyboard grid."""
+    if not image_nodes:
+        return []
+    # 1) Prefer the most recent successful storyboard image as continuity anchor (previous episode/segment).
+    storyboard_anchor: str | None = None
+    for _idx, label, n in reversed(image_nodes):
+        if label == storyboard_label:
+            continue
+        hint = f"{label}\n{n.get('promptPreview') or ''}"
+        if _STORYBOARD_HINT_RE.search(hint):
+            storyboard_anchor = label
+            break
+
+    # 2) Fill remaining slots with subject anchors (characters/products/key props),
+    # excluding storyboard/video nodes to avoid over-weighting structure over subject identity.
+    # Keep only the best (score, idx) per label, then take the top few with a
+    # bounded heap instead of sorting every candidate.
+    best_by_label: dict[str, tuple[int, int]] = {}
+    for idx, label, _n in image_nodes:
+        if label == storyboard_label:
+            continue
+        if _STORYBOARD_VIDEO_LABEL_RE.search(label):
+            continue
+        score = 0
+        if _CHARACTER_LABEL_RE.search(label):
+            score += 3
+        # Products / key props hints
+        if _PROP_LABEL_RE.search(label):
+            score += 2
+        if _SUBJECT_LABEL_RE.search(label):
+            score += 2
+        key = (score, idx)
+        prev = best_by_label.get(label)
+        if prev is None or key > prev:
+            best_by_label[label] = key
+    picked: list[str] = []
+    if storyboard_anchor:
+        picked.append(storyboard_anchor)
+        best_by_label.pop(storyboard_anchor, None)
+    picked.extend(
+        label
+        for label, _ in heapq.nlargest(
+            3 - len(picked), best_by_label.items(), key=itemgetter(1)
+        )
+    )
+    return picked
+
+
+def _pick_latest_success_image_label(
+    image_nodes: list[tuple[int, str, dict]],
+) -> str | None:
+    """Most recent successful non-storyboard image label, if any."""
+    for _idx, label, _n in reversed(image_nodes):
+        if _STORYBOARD_LABEL_RE.search(label):
+            continue
+        return label
+    return None
+
+
+def _str_arg(args: dict, *names: str) -> str | None:
+    """Return the first named argument that is a non-empty string, stripped."""
+    for name in names:
+        value = args.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+            if value:
+                return value
+    return None
+
+
+@dataclass
+class _PayloadIndex:
+    """Derived views over a tool-call payload, built in one pass.
+
+    The post-processing in finalize_answer previously re-walked the payload
+    for each question it asked (existing connections, create/run positions,
+    created labels, ...); this collects them all in a single traversal and is
+    updated in place as calls are spliced in. Labels and node ids are interned
+    on entry, so the membership checks downstream hit the pointer-equality
+    fast path and repeated turns share one canonical string per label.
+    """
+
+    connect_pairs: set[tuple[str, str]] = field(default_factory=set)
+    connect_targets: set[str] = field(default_factory=set)
+    create_idx_by_label: dict[str, int] = field(default_factory=dict)
+    run_idx_by_label: dict[str, int] = field(default_factory=dict)
+    created_image_labels: set[str] = field(default_factory=set)
+    created_video_labels: set[str] = field(default_factory=set)
+    created_image_order: list[str] = field(default_factory=list)
+    run_node_ids: set[str] = field(default_factory=set)
+
+
+def _index_tool_calls(payload: list[dict]) -> _PayloadIndex:
+    """Walk the payload once and collect every derived view the workflow checks need."""
+    idx = _PayloadIndex()
+    for i, call in enumerate(payload):
+        name = call.get("name")
+        args = call.get("arguments") or {}
+        if name == "createNode":
+            node_type = args.get("type")
+            label = _str_arg(args, "label")
+            if label:
+                label = sys.intern(label)
+                if node_type in _IMAGE_CREATE_TYPES:
+                    idx.created_image_labels.add(label)
+                    idx.created_image_order.append(label)
+                if node_type == "composeVideo":
+                    idx.created_video_labels.add(label)
+                # Track the latest create until the label's run is seen, so the
+                # splice point lands after the node being referenced.
+                if label not in idx.run_idx_by_label:
+                    idx.create_idx_by_label[label] = i
+        elif name == "runNode":
+            node_id = _str_arg(args, "nodeId")
+            if node_id:
+                node_id = sys.intern(node_id)
+                idx.run_node_ids.add(node_id)
+                idx.run_idx_by_label.setdefault(node_id, i)
+        elif name == "connectNodes":
+            src = _str_arg(args, "sourceNodeId", "sourceId")
+            tgt = _str_arg(args, "targetNodeId", "targetId")
+            if src and tgt:
+                src = sys.intern(src)
+                tgt = sys.intern(tgt)
+                idx.connect_pairs.add((src, tgt))
+                idx.connect_targets.add(tgt)
+    return idx
+
+
 def _filter_tool_calls_by_role(tool_calls: list[dict], role_id: str, allow_canvas_tools: bool) -> list[dict]:
     if not allow_canvas_tools:
         return []
@@ -903,24 +1917,256 @@ def _filter_tool_calls_by_role(tool_calls: list[dict], role_id: str, allow_canva
     return filtered
 
 
+@functools.lru_cache(maxsize=None)
 def _resolve_role(role_id: str):
-    """Return a validated role id and its profile."""
+    """Return a validated role id and its profile (cached; the role map is static)."""
     resolved_id = normalize_role_id(role_id)
     mapping = role_map()
     profile = mapping.get(resolved_id, mapping[DEFAULT_ROLE_ID])
     return resolved_id, profile
 
 
+@functools.lru_cache(maxsize=1)
+def _director_clause() -> str:
+    """The constant art-director supervision preamble of the role directive."""
+    director_id, director_profile = _resolve_role("art_director")
+    return (
+        f"总监审查（{director_profile['name']}｜{director_id}）: {director_profile['summary']}。"
+        f" 审查风格：{director_profile['style']}。"
+        f" 你必须先审查本轮是否应该执行画布动作（tool calls）、是否需要用户确认、是否保持风格/上下文一致，再输出最终回复。\n"
+    )
+
+
 # Nodes
+@functools.lru_cache(maxsize=8)
+def _get_gemini_llm(model: str, temperature: float) -> ChatGoogleGenerativeAI:
+    """Return a shared ChatGoogleGenerativeAI instance per (model, temperature).
+
+    Client construction re-reads env and rebuilds an HTTP session; reusing the
+    instance keeps connections warm across node calls.
+    """
+    require_gemini_key()
+    return ChatGoogleGenerativeAI(
+        model=model,
+        temperature=temperature,
+        max_retries=2,
+        api_key=os.getenv("GEMINI_API_KEY"),
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _get_structured_gemini(model: str, temperature: float, schema_model):
+    """Cached structured-output wrapper on top of _get_gemini_llm."""
+    return _get_gemini_llm(model, temperature).with_structured_output(schema_model)
+
+
+def _call_gemini_structured(model: str, temperature: float, prompt: str, schema_model):
+    """Gemini structured call with the same exact/semantic caching as the OpenAI path.
+
+    Cached entries store the model_dump_json text, so hits rebuild the Pydantic
+    object without any provider round-trip.
+    """
+    schema_name = schema_model.__name__
+    exact_key: str | None = None
+    if _exact_prompt_cache_enabled():
+        exact_key = _exact_cache_key(f"gemini|{model}|t={temperature}", schema_name, prompt)
+        cached_text = _exact_cache_get(exact_key)
+        if cached_text is not None:
+            try:
+                return _rebuild_cached(schema_model, cached_text)
+            except Exception:
+                pass
+    semantic_cache = _semantic_cache_enabled()
+    cache_namespace = f"gemini|{model}|{schema_name}"
+    if semantic_cache:
+        cached_text = _SEMANTIC_RESPONSE_CACHE.lookup_text(prompt, cache_namespace)
+        if isinstance(cached_text, str):
+            try:
+                return _rebuild_cached(schema_model, cached_text)
+            except Exception:
+                pass
+    result = _get_structured_gemini(model, temperature, schema_model).invoke(prompt)
+    try:
+        text = result.model_dump_json()
+    except Exception:
+        return result
+    if exact_key is not None:
+        _exact_cache_put(exact_key, text)
+    if semantic_cache:
+        _SEMANTIC_RESPONSE_CACHE.put_text(prompt, cache_namespace, text)
+    return result
+
+
+@functools.lru_cache(maxsize=1)
+def _roles_prompt_block_cached(version: tuple) -> str:
+    """Memoize the rendered roles block; `version` invalidates on role-map changes."""
+    return roles_prompt_block()
+
+
+def _roles_block() -> str:
+    """Return the roles prompt block, rebuilt only when the role map changes."""
+    return _roles_prompt_block_cached(tuple(sorted(role_map().keys())))
+
+
+# Rendered canvas-context cache: the same canvas is rendered by several nodes
+# within one turn (and across steady-state turns), so key the text by a content
+# hash instead of re-walking the node list each time.
+_CANVAS_RENDER_CACHE: OrderedDict[bytes, str] = OrderedDict()
+_CANVAS_RENDER_CACHE_MAX_ENTRIES = 8
+
+_CANVAS_DIGEST_CACHE: OrderedDict[int, tuple[dict, bytes]] = OrderedDict()
+_CANVAS_DIGEST_CACHE_MAX_ENTRIES = 4
+
+
+def _canvas_digest(canvas_context: dict) -> bytes:
+    """Content hash of a canvas context, memoized by object identity.
+
+    select_role and finalize_answer each hash the same context dict within a
+    turn, and consecutive quick-reply turns usually carry identical content;
+    memoizing by id avoids re-serializing per call while the stable digest
+    lets the derived caches hit across turns. The stored strong reference
+    keeps ids from being reused while an entry is live; contexts are never
+    mutated in place once they enter the state.
+    """
+    key = id(canvas_context)
+    cached = _CANVAS_DIGEST_CACHE.get(key)
+    if cached is not None and cached[0] is canvas_context:
+        _CANVAS_DIGEST_CACHE.move_to_end(key)
+        return cached[1]
+    raw = _canvas_fingerprint(canvas_context)
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+    digest = hashlib.blake2b(raw, digest_size=16).digest()
+    _CANVAS_DIGEST_CACHE[key] = (canvas_context, digest)
+    while len(_CANVAS_DIGEST_CACHE) > _CANVAS_DIGEST_CACHE_MAX_ENTRIES:
+        _CANVAS_DIGEST_CACHE.popitem(last=False)
+    return digest
+
+
+def _canvas_context_text(canvas_context: dict | None) -> str:
+    """Cached wrapper around _render_canvas_context_for_prompt."""
+    if not isinstance(canvas_context, dict):
+        return ""
+    try:
+        key = _canvas_digest(canvas_context)
+    except Exception:
+        return _render_canvas_context_for_prompt(canvas_context)
+    cached = _CANVAS_RENDER_CACHE.get(key)
+    if cached is not None:
+        _CANVAS_RENDER_CACHE.move_to_end(key)
+        return cached
+    text = _render_canvas_context_for_prompt(canvas_context)
+    _CANVAS_RENDER_CACHE[key] = text
+    while len(_CANVAS_RENDER_CACHE) > _CANVAS_RENDER_CACHE_MAX_ENTRIES:
+        _CANVAS_RENDER_CACHE.popitem(last=False)
+    return text
+
+
+_CANVAS_LABEL_CACHE: OrderedDict[bytes, frozenset[str]] = OrderedDict()
+_CANVAS_LABEL_CACHE_MAX_ENTRIES = 8
+
+
+def _canvas_label_set(canvas_context: dict | None) -> frozenset[str]:
+    """Return the set of trimmed node labels on the canvas.
+
+    Cached by content fingerprint so repeated checks within (and across)
+    turns on the same canvas do not re-walk the node list.
+    """
+    if not isinstance(canvas_context, dict):
+        return frozenset()
+    nodes_ctx = canvas_context.get("nodes")
+    if not isinstance(nodes_ctx, list) or not nodes_ctx:
+        return frozenset()
+    try:
+        key = _canvas_digest(canvas_context)
+    except Exception:
+        key = None
+    if key is not None:
+        cached = _CANVAS_LABEL_CACHE.get(key)
+        if cached is not None:
+            _CANVAS_LABEL_CACHE.move_to_end(key)
+            return cached
+    labels = frozenset(
+        n["label"].strip()
+        for n in nodes_ctx
+        if isinstance(n, dict) and isinstance(n.get("label"), str) and n["label"].strip()
+    )
+    if key is not None:
+        _CANVAS_LABEL_CACHE[key] = labels
+        while len(_CANVAS_LABEL_CACHE) > _CANVAS_LABEL_CACHE_MAX_ENTRIES:
+            _CANVAS_LABEL_CACHE.popitem(last=False)
+    return labels
+
+
+def _join_summaries(parts: list, sep: str) -> str:
+    """Join research summaries with fast paths for the common 0/1-element turns.
+
+    str.join is already a two-pass preallocating copy in CPython, so for the
+    multi-summary case it is the right primitive; the fast paths just skip it
+    (and the list scan) on the dominant no-research turns.
+    """
+    if not parts:
+        return ""
+    if len(parts) == 1:
+        first = parts[0]
+        return first if isinstance(first, str) else str(first)
+    return sep.join(parts)
+
+
+def _scan_last_user_text(messages) -> str:
+    for m in reversed(messages or []):
+        if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
+            return str(getattr(m, "content", "") or "")
+    return ""
+
+
+def prepare_transcript(state: OverallState, config: RunnableConfig) -> OverallState:
+    """LangGraph node that walks the message list once per turn.
+
+    Caches the rendered conversation, research topic and last user message so
+    downstream nodes read them from state instead of re-scanning the history.
+    """
+    messages = state.get("messages") or []
+    return {
+        "_transcript_cache": {
+            "prompt_text": format_messages_for_prompt(messages),
+            "research_topic": get_research_topic(messages),
+            "last_user_text": _scan_last_user_text(messages),
+        }
+    }
+
+
+def _conversation_text(state: OverallState) -> str:
+    cache = state.get("_transcript_cache")
+    if isinstance(cache, dict) and "prompt_text" in cache:
+        return cache["prompt_text"]
+    return format_messages_for_prompt(state.get("messages") or [])
+
+
+def _research_topic(state: OverallState) -> str:
+    cache = state.get("_transcript_cache")
+    if isinstance(cache, dict) and "research_topic" in cache:
+        return cache["research_topic"]
+    return get_research_topic(state.get("messages") or [])
+
+
+def _last_user_text(state: OverallState) -> str:
+    cache = state.get("_transcript_cache")
+    if isinstance(cache, dict) and "last_user_text" in cache:
+        return cache["last_user_text"]
+    return _scan_last_user_text(state.get("messages") or [])
+
+
 def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
     """Pick the active assistant role based on the latest conversation."""
     configurable = Configuration.from_runnable_config(config)
     llm_provider = configurable.llm_provider.lower()
-    conversation = format_messages_for_prompt(state["messages"])
+    conversation = _conversation_text(state)
     canvas_context = state.get("canvas_context")
-    canvas_context_text = _render_canvas_context_for_prompt(canvas_context)
-    prompt = role_router_instructions.format(
-        roles_block=roles_prompt_block(),
+    canvas_context_text = _canvas_context_text(canvas_context)
+    prompt = render_prompt(
+        role_router_instructions,
+        roles_block=_roles_block(),
         default_role_id=DEFAULT_ROLE_ID,
         conversation=conversation,
         canvas_context=canvas_context_text,
@@ -933,14 +2179,9 @@ def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
             RoleDecision,
         )
     else:
-        require_gemini_key()
-        llm = ChatGoogleGenerativeAI(
-            model=configurable.role_selector_model,
-            temperature=0,
-            max_retries=2,
-            api_key=os.getenv("GEMINI_API_KEY"),
+        result = _call_gemini_structured(
+            configurable.role_selector_model, 0, prompt, RoleDecision
         )
-        result = llm.with_structured_output(RoleDecision).invoke(prompt)
 
     resolved_id, profile = _resolve_role(result.role_id)
     reason = result.reason or "基于对话意图的默认选择。"
@@ -966,11 +2207,7 @@ def select_role(state: OverallState, config: RunnableConfig) -> OverallState:
     # For very short, low-information user turns that do not contain any creation intent,
     # default to not executing canvas tools in this turn.
     try:
-        last_user_text = ""
-        for m in reversed(state.get("messages") or []):
-            if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-                last_user_text = str(getattr(m, "content", "") or "")
-                break
+        last_user_text = _last_user_text(state)
         t = (last_user_text or "").strip()
         # Collapse whitespace
         t_compact = " ".join(t.split())
@@ -1046,9 +2283,10 @@ def generate_query(state: OverallState, config: RunnableConfig) -> QueryGenerati
     # OpenAI path (Responses API)
     if llm_provider == "openai":
         current_date = get_current_date()
-        formatted_prompt = query_writer_instructions.format(
+        formatted_prompt = render_prompt(
+        query_writer_instructions,
             current_date=current_date,
-            research_topic=get_research_topic(state["messages"]),
+            research_topic=_research_topic(state),
             number_queries=state["initial_search_query_count"],
         )
         result = _call_openai_structured(
@@ -1056,25 +2294,18 @@ def generate_query(state: OverallState, config: RunnableConfig) -> QueryGenerati
         )
         return {"search_query": result.query}
 
-    # init Gemini 2.0 Flash
-    require_gemini_key()
-    llm = ChatGoogleGenerativeAI(
-        model=configurable.query_generator_model,
-        temperature=1.0,
-        max_retries=2,
-        api_key=os.getenv("GEMINI_API_KEY"),
-    )
-    structured_llm = llm.with_structured_output(SearchQueryList)
-
     # Format the prompt
     current_date = get_current_date()
-    formatted_prompt = query_writer_instructions.format(
+    formatted_prompt = render_prompt(
+        query_writer_instructions,
         current_date=current_date,
-        research_topic=get_research_topic(state["messages"]),
+        research_topic=_research_topic(state),
         number_queries=state["initial_search_query_count"],
     )
-    # Generate the search queries
-    result = structured_llm.invoke(formatted_prompt)
+    # Generate the search queries (Gemini 2.0 Flash)
+    result = _call_gemini_structured(
+        configurable.query_generator_model, 1.0, formatted_prompt, SearchQueryList
+    )
     return {"search_query": result.query}
 
 
@@ -1089,10 +2320,24 @@ def continue_to_web_research(state: QueryGenerationState):
     ]
 
 
-def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
+# One semaphore per concurrency limit: web_research Sends share the limiter so a
+# large fan-out cannot exhaust provider rate limits.
+_SEARCH_SEMAPHORES: dict[int, asyncio.Semaphore] = {}
+
+
+def _search_semaphore(limit: int) -> asyncio.Semaphore:
+    sem = _SEARCH_SEMAPHORES.get(limit)
+    if sem is None:
+        sem = _SEARCH_SEMAPHORES[limit] = asyncio.Semaphore(max(1, limit))
+    return sem
+
+
+async def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
     """LangGraph node that performs web research using the native Google Search API tool.
 
     Executes a web search using the native Google Search API tool in combination with Gemini 2.0 Flash.
+    Async so that the fan-out Sends from continue_to_web_research actually overlap;
+    concurrency is bounded by configurable.max_concurrent_searches.
 
     Args:
         state: Current graph state containing the search query and research loop count
@@ -1104,7 +2349,8 @@ def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
     # Configure
     configurable = Configuration.from_runnable_config(config)
     provider = configurable.search_provider.lower()
-    formatted_prompt = web_searcher_instructions.format(
+    formatted_prompt = render_prompt(
+        web_searcher_instructions,
         current_date=get_current_date(),
         research_topic=state["search_query"],
     )
@@ -1116,22 +2362,25 @@ def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
             "web_research_result": ["[mocked search result: no external search performed]"],
         }
 
+    semaphore = _search_semaphore(configurable.max_concurrent_searches)
+
     if provider == "openai":
-        openai_client = get_openai_client()
+        openai_client = get_async_openai_client()
         try:
-            completion = openai_client.responses.create(
-                model=configurable.search_model,
-                input=[
-                    {
-                        "role": "user",
-                        "content": [{"type": "input_text", "text": formatted_prompt}],
-                    }
-                ],
-                tools=[{"type": "web_search"}],
-                stream=True,
-            )
-            debug_openai_response("web_research", completion)
-            output_text = _collect_stream_text(completion)
+            async with semaphore:
+                completion = await openai_client.responses.create(
+                    model=configurable.search_model,
+                    input=[
+                        {
+                            "role": "user",
+                            "content": [{"type": "input_text", "text": formatted_prompt}],
+                        }
+                    ],
+                    tools=[{"type": "web_search"}],
+                    stream=True,
+                )
+                debug_openai_response("web_research", completion)
+                output_text = await _acollect_stream_text(completion)
         except (APIConnectionError, OpenAIError, Exception):
             output_text = "搜索失败：OpenAI API 未返回结果（连接或接口异常）。"
         return {
@@ -1143,22 +2392,17 @@ def web_research(state: WebSearchState, config: RunnableConfig) -> OverallState:
     # Default to Gemini search
     # Uses the google genai client as the langchain client doesn't return grounding metadata
     genai_client = get_genai_client()
-    response = genai_client.models.generate_content(
-        model=configurable.search_model,
-        contents=formatted_prompt,
-        config={
-            "tools": [{"google_search": {}}],
-            "temperature": 0,
-        },
-    )
-    # resolve the urls to short urls for saving tokens and time
-    resolved_urls = resolve_urls(
-        response.candidates[0].grounding_metadata.grounding_chunks, state["id"]
-    )
-    # Gets the citations and adds them to the generated text
-    citations = get_citations(response, resolved_urls)
-    modified_text = insert_citation_markers(response.text, citations)
-    sources_gathered = [item for citation in citations for item in citation["segments"]]
+    async with semaphore:
+        response = await genai_client.aio.models.generate_content(
+            model=configurable.search_model,
+            contents=formatted_prompt,
+            config={
+                "tools": [{"google_search": {}}],
+                "temperature": 0,
+            },
+        )
+    # Resolve short urls, build citations, and annotate the text in one pass.
+    modified_text, sources_gathered = annotate_and_collect(response, state["id"])
 
     return {
         "sources_gathered": sources_gathered,
@@ -1189,10 +2433,11 @@ def reflection(state: OverallState, config: RunnableConfig) -> ReflectionState:
 
     # Format the prompt
     current_date = get_current_date()
-    formatted_prompt = reflection_instructions.format(
+    formatted_prompt = render_prompt(
+        reflection_instructions,
         current_date=current_date,
-        research_topic=get_research_topic(state["messages"]),
-        summaries="\n\n---\n\n".join(state["web_research_result"]),
+        research_topic=_research_topic(state),
+        summaries=_join_summaries(state["web_research_result"], "\n\n---\n\n"),
     )
     # OpenAI path (Responses API)
     if llm_provider == "openai":
@@ -1210,14 +2455,7 @@ def reflection(state: OverallState, config: RunnableConfig) -> ReflectionState:
         }
 
     # init Reasoning Model
-    require_gemini_key()
-    llm = ChatGoogleGenerativeAI(
-        model=reasoning_model,
-        temperature=1.0,
-        max_retries=2,
-        api_key=os.getenv("GEMINI_API_KEY"),
-    )
-    result = llm.with_structured_output(Reflection).invoke(formatted_prompt)
+    result = _call_gemini_structured(reasoning_model, 1.0, formatted_prompt, Reflection)
 
     return {
         "is_sufficient": result.is_sufficient,
@@ -1272,6 +2510,184 @@ def evaluate_research(
         ]
 
 
+# Keyword categories scanned against user text / node labels in finalize_answer.
+# One compiled alternation per category replaces the per-keyword substring loops.
+_CONTINUATION_RE = re.compile("续写|后续剧情|接下来|续作")
+_SUGGEST_VERBS_RE = re.compile("推荐|方向|灵感|怎么写")
+_STORY_KIND_RE = re.compile("九宫格|分镜|故事板|storyboard|15s")
+_STORYBOARD_INTENT_RE = re.compile("九宫格|分镜|故事板|storyboard|短片|动画|成片|15s|15秒")
+_LOCK_CONFIRM_RE = re.compile("确认锁定|锁定场景|锁定主体|锁定风格|确认风格|风格锁定|我确认|确认：")
+_IMPLICIT_LOCK_RE = re.compile("继续|按你给的|就按这个|照这个来|不用确认|直接生成|别问了")
+_DIRECTION_CHOICE_RE = re.compile("我选择方向|自定义续写|续写")
+_STORYBOARD_HINT_RE = re.compile("九宫格|3x3|分镜|storyboard")
+_STORYBOARD_LABEL_RE = re.compile("分镜|九宫格|storyboard")
+_STORYBOARD_VIDEO_LABEL_RE = re.compile("分镜|九宫格|storyboard|视频")
+_CHARACTER_LABEL_RE = re.compile("角色|设定|立绘|主视觉|character|design")
+_PROP_LABEL_RE = re.compile("产品|道具|物件|prop|product")
+_SUBJECT_LABEL_RE = re.compile("fox|bunny|rabbit|狐狸|兔子", re.IGNORECASE)
+_WANTS_STORYBOARD_RE = re.compile("分镜|故事板|storyboard|九宫格|15s")
+
+# Node kinds treated as image-producing on the canvas (O(1) membership in hot loops).
+_IMAGE_KINDS = frozenset({"image", "textToImage", "mosaic"})
+_IMAGE_CREATE_TYPES = frozenset({"image", "textToImage"})
+_REF_INTENT_RE = re.compile("基于|同款|同风格|沿用|续写|延展|变体|参考|保持一致")
+# Longest alternative first so 九宫格分镜 is not split by the shorter 分镜.
+_VIDEO_LABEL_RE = re.compile("九宫格分镜|分镜")
+
+_VIDEO_PROMPT_TMPL = (
+    "根据上游参考图片（九宫格分镜图）生成一个15秒的二维动画视频：\n"
+    "- 画面风格/角色外观严格跟随参考图；不要改变角色造型与配色。\n"
+    "- 按参考图的镜头节奏推进（从1到9），镜头之间自然衔接；保持同一场景光线连续。\n"
+    "- 不要出现任何可读文字/水印/Logo。\n"
+    "- 输出16:9，动作清晰，镜头稳定，节奏温暖治愈。"
+)
+
+# Collapses blank lines and per-line edge whitespace in one substitution.
+# The class lists every boundary str.splitlines recognizes, so stripped-and-
+# rejoined output matches a per-line strip/filter exactly.
+_LINE_EDGE_WS_RE = re.compile(r"(?:\s*[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]\s*)+")
+
+
+# Canned quick-reply option sets returned to the frontend. They are read-only
+# JSON sinks, so the dicts are shared and only the outer list is copied per turn.
+_QUICK_REPLIES_SAFETY_PG13 = (
+    {
+        "label": "改成含蓄浪漫（不露骨）",
+        "input": "把刚才的内容改写成含蓄浪漫、PG-13表达：不出现裸体/性行为/露骨描写，用暗示与情绪推进；然后再生成九宫格分镜。",
+    },
+    {
+        "label": "改成亲密但克制",
+        "input": "把亲密内容改成拥抱/牵手/靠近等克制表达（不涉及色情），强调关系与情绪；然后再生成分镜/视频。",
+    },
+    {
+        "label": "只保留剧情，不生成画面",
+        "input": "先不要生成画面。把内容改成适合大众平台的剧情梗概（不露骨），并给我3个可选走向按钮。",
+    },
+    {
+        "label": "我只是要分镜（无色情）",
+        "input": "我这段没有色情/裸露/性行为内容，只是要做分镜与提示词；请按原剧情继续生成九宫格分镜与统一提示词，并在提示词里明确：无裸露、无性行为、PG-13。",
+    },
+)
+
+_QUICK_REPLIES_STORY_DIRECTIONS = (
+    {
+        "label": "方向A：暖心日常",
+        "input": "我选择方向A（暖心日常）：请基于当前项目已有剧情与角色关系（沿用同一世界观/场景/氛围）续写下一段 15 秒的小故事。先给我紧凑剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
+    },
+    {
+        "label": "方向B：轻冒险任务",
+        "input": "我选择方向B（轻冒险任务）：请基于当前项目已有剧情续写，加入一个小目标/小危机但保持治愈基调。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
+    },
+    {
+        "label": "方向C：小悬疑反转",
+        "input": "我选择方向C（小悬疑反转）：请基于当前项目已有剧情续写，前半段制造小谜团，结尾温暖反转（不要跳出既有设定）。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
+    },
+    {
+        "label": "自定义方向…",
+        "input": "我想自定义续写方向（基于当前项目已有剧情，不要另起炉灶）：\n- 主题/情绪：\n- 场景：\n- 关键事件：\n- 结尾落点：\n请基于我的填写先给梗概，再做九宫格分镜与15s视频。",
+    },
+)
+
+_QUICK_REPLIES_STYLE_LOCK_DEFAULT = (
+    {
+        "label": "继续（默认锁定：日漫2D）",
+        "input": "确认锁定风格：日漫2D（干净线稿+赛璐璐）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
+    },
+    {
+        "label": "锁定风格：美漫2D（粗线条）",
+        "input": "确认锁定风格：美漫2D（粗线条+高对比）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
+    },
+    {
+        "label": "锁定风格：写实真人",
+        "input": "确认锁定风格：写实真人（电影质感）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
+    },
+    {
+        "label": "自定义风格…",
+        "input": "确认锁定风格：\n- 风格类型（2D日漫/2D美漫/写实/其他）：\n- 线条/材质：\n- 色彩与光影：\n- 镜头语言：\n同时：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。填写后请生成 3x3 九宫格分镜图并连线参考图。",
+    },
+)
+
+_QUICK_REPLIES_STYLE_LOCK_TAIL = (
+    {
+        "label": "新增主体…（先出设定图）",
+        "input": "我要新增主体（角色/产品/关键道具）：\n- 主体1：\n- 主体2：\n要求：先分别生成每个主体的设定图（image），等我确认后再生成九宫格分镜并连线消费这些设定图。",
+    },
+    {
+        "label": "改场景…（先锁定场景图）",
+        "input": "我想锁定新的主场景：\n- 场景描述：\n要求：先生成一张“场景设定图”（image）给我确认；确认后九宫格分镜必须只在该场景内推进（光线连续），再生成15s视频。",
+    },
+    {
+        "label": "自定义锁定规则…",
+        "input": "我想自定义锁定规则：\n- 主场景（只能一个）：\n- 允许的过渡场景（可选）：\n- 主体清单（角色/产品/道具）与数量：\n- 禁止事项：\n请按我的规则先补齐必要的设定图，再生成九宫格分镜并继续。",
+    },
+)
+
+_QUICK_REPLIES_NO_CANVAS = (
+    {
+        "label": "继续创作（先选方向）",
+        "input": "基于我当前项目画布，先给 3 个可选方向（按钮）让我选；我选完你再在画布创建分镜/视频节点。",
+    },
+    {
+        "label": "直接生成（我给具体需求）",
+        "input": "我想在画布生成一个内容：\n- 类型（图片/分镜/视频）：\n- 主题：\n- 风格：\n- 时长/比例（如需要）：\n请按我的填写创建节点并执行。",
+    },
+    {
+        "label": "只聊不操作画布",
+        "input": "先不操作画布。请先用一句话问我：我想做什么类型的内容、有什么参考、以及希望的风格/时长。",
+    },
+)
+
+_QUICK_REPLIES_CHARACTER_CONFIRM = (
+    {
+        "label": "角色OK，继续分镜",
+        "input": "新角色我确认OK。请把新角色纳入同一项目设定，基于已有剧情续写下一段，并生成九宫格分镜（image）再连接到15s视频（composeVideo）。",
+    },
+    {
+        "label": "重做这个角色",
+        "input": "这个新角色不满意。请保持同一角色定位与风格，重做 3 个版本给我选（同一个 image 节点出 3 张即可）。",
+    },
+    {
+        "label": "不要新角色",
+        "input": "不要新增角色了。请只用现有角色基于已有剧情续写，并生成九宫格分镜与15s视频。",
+    },
+)
+
+
+_TAPCANVAS_ACTIONS_RE = re.compile(r"```tapcanvas_actions[^\n]*\n(.*?)```", re.DOTALL)
+
+
+def _extract_tapcanvas_actions(text: str) -> tuple[str, list[dict] | None]:
+    """Strip the tapcanvas_actions fenced block from `text` and parse its actions."""
+    if not isinstance(text, str) or "```tapcanvas_actions" not in text:
+        return text, None
+    match = _TAPCANVAS_ACTIONS_RE.search(text)
+    if match is None:
+        return text, None
+    payload_raw = match.group(1).strip()
+    cleaned = (text[: match.start()] + text[match.end() :]).strip()
+    try:
+        obj = _json_loads(payload_raw)
+    except Exception:
+        return cleaned, None
+    actions = obj.get("actions") if isinstance(obj, dict) else None
+    if not isinstance(actions, list):
+        return cleaned, None
+    normalized: list[dict] = []
+    for item in actions:
+        if not isinstance(item, dict):
+            continue
+        label = item.get("label")
+        input_text = item.get("input")
+        if not isinstance(label, str) or not label.strip():
+            continue
+        if not isinstance(input_text, str) or not input_text.strip():
+            continue
+        normalized.append({"label": label.strip(), "input": input_text})
+        if len(normalized) >= 6:
+            break
+    return cleaned, normalized or None
+
+
 def finalize_answer(state: OverallState, config: RunnableConfig):
     """LangGraph node that finalizes the research summary.
 
@@ -1295,68 +2711,28 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
     # Resolve role directive for persona-aware answer.
     # Always include an "art director" supervision rubric, even when a specialist role is active.
     resolved_id, profile = _resolve_role(state.get("active_role", DEFAULT_ROLE_ID))
-    director_id, director_profile = _resolve_role("art_director")
     role_directive = (
-        f"总监审查（{director_profile['name']}｜{director_id}）: {director_profile['summary']}。"
-        f" 审查风格：{director_profile['style']}。"
-        f" 你必须先审查本轮是否应该执行画布动作（tool calls）、是否需要用户确认、是否保持风格/上下文一致，再输出最终回复。\n"
-        f"主执行角色（{profile['name']}｜{resolved_id}）: {profile['summary']}。回复风格：{profile['style']}。"
+        _director_clause()
+        + f"主执行角色（{profile['name']}｜{resolved_id}）: {profile['summary']}。回复风格：{profile['style']}。"
         f" 选择原因：{state.get('active_role_reason', '根据对话意图选择。')}"
     )
 
     # Format the prompt
     current_date = get_current_date()
     canvas_context = state.get("canvas_context")
-    canvas_context_text = _render_canvas_context_for_prompt(canvas_context)
-    formatted_prompt = answer_instructions.format(
+    canvas_context_text = _canvas_context_text(canvas_context)
+    formatted_prompt = render_prompt(
+        answer_instructions,
         current_date=current_date,
-        research_topic=get_research_topic(state["messages"]),
+        research_topic=_research_topic(state),
         role_directive=role_directive,
-        summaries="\n---\n\n".join(state["web_research_result"]),
+        summaries=_join_summaries(state["web_research_result"], "\n---\n\n"),
         canvas_context=canvas_context_text,
     )
     tool_calls_payload: list[dict] = []
     llm_error_payload: dict | None = None
     quick_replies_payload: list[dict] | None = None
 
-    def _extract_tapcanvas_actions(text: str) -> tuple[str, list[dict] | None]:
-        if not isinstance(text, str) or "```" not in text:
-            return text, None
-        marker = "```tapcanvas_actions"
-        start = text.find(marker)
-        if start < 0:
-            return text, None
-        start_payload = text.find("\n", start + len(marker))
-        if start_payload < 0:
-            return text, None
-        start_payload = start_payload + 1
-        end_fence = text.find("```", start_payload)
-        if end_fence < 0:
-            return text, None
-        payload_raw = text[start_payload:end_fence].strip()
-        cleaned = (text[:start] + text[end_fence + 3 :]).strip()
-        try:
-            obj = json.loads(payload_raw)
-        except Exception:
-            return cleaned, None
-        actions = obj.get("actions") if isinstance(obj, dict) else None
-        if not isinstance(actions, list):
-            return cleaned, None
-        normalized: list[dict] = []
-        for item in actions:
-            if not isinstance(item, dict):
-                continue
-            label = item.get("label")
-            input_text = item.get("input")
-            if not isinstance(label, str) or not label.strip():
-                continue
-            if not isinstance(input_text, str) or not input_text.strip():
-                continue
-            normalized.append({"label": label.strip(), "input": input_text})
-            if len(normalized) >= 6:
-                break
-        return cleaned, normalized or None
-
     allow_canvas_tools = bool(state.get("allow_canvas_tools", True))
     role_tools = _tool_definitions_for_role(resolved_id, allow_canvas_tools)
 
@@ -1379,872 +2755,560 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             debug_openai_response("finalize_answer", completion)
             result_text, tool_calls_payload = _collect_stream_text_and_tools(completion)
             tool_calls_payload = _filter_tool_calls_by_role(tool_calls_payload, resolved_id, allow_canvas_tools)
-
-            # If the user is asking for open-ended story continuation recommendations,
-            # do NOT auto-create storyboard/video nodes in this turn; offer selectable directions.
-            last_user_text = ""
-            try:
-                for m in reversed(state.get("messages") or []):
-                    if getattr(m, "type", None) == "human" or getattr(m, "role", None) == "user":
-                        last_user_text = str(getattr(m, "content", "") or "")
-                        break
-            except Exception:
-                last_user_text = ""
-
-            # Always-on "magician" content safety:
-            # - Safety classification should be decided by an LLM (not brittle keyword lists).
-            # - We only use lightweight sanitization transforms AFTER classification.
-            def _classify_safety(user_text: str, planned_prompts: str) -> SafetyDecision:
-                model = getattr(configurable, "safety_classifier_model", None) or configurable.role_selector_model
-                payload = (
-                    "You are a strict-but-practical content safety classifier for a public creative tool.\n"
-                    "Task: judge whether the request/planned prompts contain explicit sexual content, explicit nudity, graphic gore, or explicit violence.\n"
-                    "Rules:\n"
-                    "- sexual=true only for explicit sexual acts/pornographic intent.\n"
-                    "- nudity=true if explicit nudity is requested or described for output.\n"
-                    "- gore=true only for graphic body harm/viscera/dismemberment close-ups.\n"
-                    "- violence=true for explicit harm descriptions that should be softened to PG-13 cinematic implication.\n"
-                    "- should_block=true if the assistant must refuse direct generation and ask to rewrite first (typically sexual/porn; or extreme gore).\n"
-                    "- should_sanitize=true if output should be rewritten/softened (PG-13) before proceeding.\n"
-                    "Return a JSON object matching the provided schema.\n\n"
-                    "USER_TEXT:\n"
-                    f"{(user_text or '').strip()}\n\n"
-                    "PLANNED_PROMPTS (may be empty):\n"
-                    f"{(planned_prompts or '').strip()}\n"
-                )
-                try:
-                    return _call_openai_structured(model, payload, SafetyDecision)
-                except Exception:
-                    # Fallback: assume safe but keep sanitization enabled in prompts via negativePrompt.
-                    return SafetyDecision(
-                        sexual=False,
-                        nudity=False,
-                        gore=False,
-                        violence=False,
-                        should_block=False,
-                        should_sanitize=True,
-                        reason="Fallback: classifier unavailable.",
+            if not allow_canvas_tools:
+                # Router disallowed canvas side-effects for this turn: no tools
+                # were offered, so skip the storyboard/safety/normalization
+                # post-processing entirely.
+                tool_calls_payload = []
+                quick_replies_payload = list(_QUICK_REPLIES_NO_CANVAS)
+                if not isinstance(result_text, str) or not result_text.strip():
+                    result_text = "我先不动画布。你想先聊清楚需求，还是直接点一个选项让我开始执行？"
+            else:
+                # If the user is asking for open-ended story continuation recommendations,
+                # do NOT auto-create storyboard/video nodes in this turn; offer selectable directions.
+                last_user_text = _last_user_text(state)
+
+                # Always-on "magician" content safety:
+                # - Safety classification should be decided by an LLM (not brittle keyword lists).
+                # - We only use lightweight sanitization transforms AFTER classification.
+                def _classify_safety(user_text: str, planned_prompts: str) -> SafetyDecision:
+                    model = getattr(configurable, "safety_classifier_model", None) or configurable.role_selector_model
+                    payload = (
+                        "You are a strict-but-practical content safety classifier for a public creative tool.\n"
+                        "Task: judge whether the request/planned prompts contain explicit sexual content, explicit nudity, graphic gore, or explicit violence.\n"
+                        "Rules:\n"
+                        "- sexual=true only for explicit sexual acts/pornographic intent.\n"
+                        "- nudity=true if explicit nudity is requested or described for output.\n"
+                        "- gore=true only for graphic body harm/viscera/dismemberment close-ups.\n"
+                        "- violence=true for explicit harm descriptions that should be softened to PG-13 cinematic implication.\n"
+                        "- should_block=true if the assistant must refuse direct generation and ask to rewrite first (typically sexual/porn; or extreme gore).\n"
+                        "- should_sanitize=true if output should be rewritten/softened (PG-13) before proceeding.\n"
+                        "Return a JSON object matching the provided schema.\n\n"
+                        "USER_TEXT:\n"
+                        f"{(user_text or '').strip()}\n\n"
+                        "PLANNED_PROMPTS (may be empty):\n"
+                        f"{(planned_prompts or '').strip()}\n"
                     )
+                    try:
+                        return _call_openai_structured(model, payload, SafetyDecision)
+                    except Exception:
+                        # Fallback: assume safe but keep sanitization enabled in prompts via negativePrompt.
+                        return SafetyDecision(
+                            sexual=False,
+                            nudity=False,
+                            gore=False,
+                            violence=False,
+                            should_block=False,
+                            should_sanitize=True,
+                            reason="Fallback: classifier unavailable.",
+                        )
 
-            def _sanitize_sexual_text(text: str) -> str:
-                if not isinstance(text, str) or not text.strip():
-                    return text
-                replacements = {
-                    "无码": "（不展示细节）",
-                    "露点": "穿着完整（不露骨）",
-                    "裸体": "穿着完整（不露骨）",
-                    "性交": "亲密互动（不露骨）",
-                    "做爱": "亲密互动（不露骨）",
-                    "口交": "亲密互动（不露骨）",
-                    "肛交": "亲密互动（不露骨）",
-                    "强奸": "性侵（不展示细节，仅点到为止）",
-                    "迷奸": "性侵（不展示细节，仅点到为止）",
-                    "porn": "（不露骨）",
-                }
-                out = text
-                for k, v in replacements.items():
-                    out = out.replace(k, v)
-                return out
-
-            def _sanitize_violent_text(text: str) -> str:
-                if not isinstance(text, str) or not text.strip():
-                    return text
-                replacements = {
-                    "爆头": "强烈冲击（不展示细节）",
-                    "脑浆": "冲击性的后果（不展示细节）",
-                    "断肢": "受伤倒下（不展示细节）",
-                    "肢解": "镜头切走（用暗示表达）",
-                    "开膛": "镜头切走（用暗示表达）",
-                    "剖腹": "镜头切走（用暗示表达）",
-                    "内脏": "不展示细节",
-                    "肠子": "不展示细节",
-                    "碎尸": "不展示细节",
-                    "割喉": "镜头切走（用暗示表达）",
-                    "斩首": "镜头切走（用暗示表达）",
-                    "砍头": "镜头切走（用暗示表达）",
-                    "喷血": "用剪影/反应镜头表达冲击（不展示细节）",
-                    "血浆": "用光影/音效表达冲击（不展示细节）",
-                    "血肉模糊": "画面用遮挡/虚焦表达（不展示细节）",
-                }
-                out = text
-                for k, v in replacements.items():
-                    out = out.replace(k, v)
-                return out
-
-            tool_prompts_text = ""
-            try:
-                for c in tool_calls_payload or []:
-                    if c.get("name") != "createNode":
-                        continue
-                    args = c.get("arguments") or {}
-                    cfg = args.get("config")
-                    if isinstance(cfg, dict):
-                        p = cfg.get("prompt")
-                        if isinstance(p, str) and p.strip():
-                            tool_prompts_text += "\n" + p
-            except Exception:
-                pass
-            safety = _classify_safety(last_user_text or "", tool_prompts_text)
+                def _sanitize_sexual_text(text: str) -> str:
+                    if not isinstance(text, str) or not text.strip():
+                        return text
+                    replacements = {
+                        "无码": "（不展示细节）",
+                        "露点": "穿着完整（不露骨）",
+                        "裸体": "穿着完整（不露骨）",
+                        "性交": "亲密互动（不露骨）",
+                        "做爱": "亲密互动（不露骨）",
+                        "口交": "亲密互动（不露骨）",
+                        "肛交": "亲密互动（不露骨）",
+                        "强奸": "性侵（不展示细节，仅点到为止）",
+                        "迷奸": "性侵（不展示细节，仅点到为止）",
+                        "porn": "（不露骨）",
+                    }
+                    out = text
+                    for k, v in replacements.items():
+                        out = out.replace(k, v)
+                    return out
+
+                def _sanitize_violent_text(text: str) -> str:
+                    if not isinstance(text, str) or not text.strip():
+                        return text
+                    replacements = {
+                        "爆头": "强烈冲击（不展示细节）",
+                        "脑浆": "冲击性的后果（不展示细节）",
+                        "断肢": "受伤倒下（不展示细节）",
+                        "肢解": "镜头切走（用暗示表达）",
+                        "开膛": "镜头切走（用暗示表达）",
+                        "剖腹": "镜头切走（用暗示表达）",
+                        "内脏": "不展示细节",
+                        "肠子": "不展示细节",
+                        "碎尸": "不展示细节",
+                        "割喉": "镜头切走（用暗示表达）",
+                        "斩首": "镜头切走（用暗示表达）",
+                        "砍头": "镜头切走（用暗示表达）",
+                        "喷血": "用剪影/反应镜头表达冲击（不展示细节）",
+                        "血浆": "用光影/音效表达冲击（不展示细节）",
+                        "血肉模糊": "画面用遮挡/虚焦表达（不展示细节）",
+                    }
+                    out = text
+                    for k, v in replacements.items():
+                        out = out.replace(k, v)
+                    return out
 
-            if safety.should_block and (safety.sexual or safety.nudity):
-                tool_calls_payload = []
-                quick_replies_payload = [
-                    {
-                        "label": "改成含蓄浪漫（不露骨）",
-                        "input": "把刚才的内容改写成含蓄浪漫、PG-13表达：不出现裸体/性行为/露骨描写，用暗示与情绪推进；然后再生成九宫格分镜。",
-                    },
-                    {
-                        "label": "改成亲密但克制",
-                        "input": "把亲密内容改成拥抱/牵手/靠近等克制表达（不涉及色情），强调关系与情绪；然后再生成分镜/视频。",
-                    },
-                    {
-                        "label": "只保留剧情，不生成画面",
-                        "input": "先不要生成画面。把内容改成适合大众平台的剧情梗概（不露骨），并给我3个可选走向按钮。",
-                    },
-                    {
-                        "label": "我只是要分镜（无色情）",
-                        "input": "我这段没有色情/裸露/性行为内容，只是要做分镜与提示词；请按原剧情继续生成九宫格分镜与统一提示词，并在提示词里明确：无裸露、无性行为、PG-13。",
-                    },
-                ]
-                result_text = (
-                    "内容安全检查判定为需要先降级到 PG-13（不露骨、不裸露）。"
-                    "我不会生成露骨色情内容；可以先把表达改成含蓄、电影化暗示再继续做分镜/视频。点一个按钮继续。"
-                )
-            elif safety.should_sanitize and (safety.sexual or safety.nudity):
-                # Sanitize prompts and add safety negatives, but do not hard-block the whole turn.
-                try:
-                    for c in tool_calls_payload or []:
-                        if c.get("name") != "createNode":
-                            continue
-                        args = c.get("arguments") or {}
-                        cfg = args.get("config")
-                        if not isinstance(cfg, dict):
-                            continue
-                        if isinstance(cfg.get("prompt"), str):
-                            cfg["prompt"] = _sanitize_sexual_text(cfg["prompt"])
-                        neg = cfg.get("negativePrompt")
-                        neg_text = neg if isinstance(neg, str) else ""
-                        add_neg = "nude, naked, explicit sex, porn, nipples, genitalia"
-                        if add_neg not in neg_text:
-                            cfg["negativePrompt"] = (neg_text + ("\n" if neg_text else "") + add_neg).strip()
-                except Exception:
-                    pass
-            elif safety.should_sanitize and (safety.gore or safety.violence):
-                result_text = _sanitize_violent_text(result_text or "")
+                tool_prompt_parts: list[str] = []
                 try:
                     for c in tool_calls_payload or []:
                         if c.get("name") != "createNode":
                             continue
                         args = c.get("arguments") or {}
                         cfg = args.get("config")
-                        if not isinstance(cfg, dict):
-                            continue
-                        if isinstance(cfg.get("prompt"), str):
-                            cfg["prompt"] = _sanitize_violent_text(cfg["prompt"])
-                        neg = cfg.get("negativePrompt")
-                        neg_text = neg if isinstance(neg, str) else ""
-                        add_neg = "gore, dismemberment, intestines, brains, blood splatter close-up, explicit violence, torture porn, nude, explicit sex"
-                        if add_neg not in neg_text:
-                            cfg["negativePrompt"] = (neg_text + ("\n" if neg_text else "") + add_neg).strip()
+                        if isinstance(cfg, dict):
+                            p = cfg.get("prompt")
+                            if isinstance(p, str) and p.strip():
+                                tool_prompt_parts.append(p)
                 except Exception:
                     pass
-            is_story_suggestion_request = (
-                any(k in (last_user_text or "") for k in ("续写", "后续剧情", "接下来", "续作"))
-                and any(k in (last_user_text or "") for k in ("推荐", "方向", "灵感", "怎么写"))
-                and not any(k in (last_user_text or "") for k in ("九宫格", "分镜", "故事板", "storyboard", "15s"))
-            )
-
-            if is_story_suggestion_request and "tapcanvas_actions" not in (result_text or ""):
-                # Prevent unintended canvas actions triggered by the model.
-                tool_calls_payload = []
-                quick_replies_payload = [
-                    {
-                        "label": "方向A：暖心日常",
-                        "input": "我选择方向A（暖心日常）：请基于当前项目已有剧情与角色关系（沿用同一世界观/场景/氛围）续写下一段 15 秒的小故事。先给我紧凑剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
-                    },
-                    {
-                        "label": "方向B：轻冒险任务",
-                        "input": "我选择方向B（轻冒险任务）：请基于当前项目已有剧情续写，加入一个小目标/小危机但保持治愈基调。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
-                    },
-                    {
-                        "label": "方向C：小悬疑反转",
-                        "input": "我选择方向C（小悬疑反转）：请基于当前项目已有剧情续写，前半段制造小谜团，结尾温暖反转（不要跳出既有设定）。先给剧情梗概（3-5句），再生成九宫格分镜（image）并连接到15s视频（composeVideo）。",
-                    },
-                    {
-                        "label": "自定义方向…",
-                        "input": "我想自定义续写方向（基于当前项目已有剧情，不要另起炉灶）：\n- 主题/情绪：\n- 场景：\n- 关键事件：\n- 结尾落点：\n请基于我的填写先给梗概，再做九宫格分镜与15s视频。",
-                    },
-                ]
-                result_text = "给你 3 个续写方向，点一个我就按这个继续写；也可以选“自定义方向”把你想要的走向填进去。"
-
-            # Storyboard/video continuity gate:
-            # To avoid abrupt scene drift and accidental new subjects, require an explicit "lock" confirmation
-            # before creating storyboard/video nodes, unless the user already confirmed.
-            storyboard_intent = any(
-                k in (last_user_text or "")
-                for k in ("九宫格", "分镜", "故事板", "storyboard", "短片", "动画", "成片", "15s", "15秒")
-            )
-            has_lock_confirmation = any(
-                k in (last_user_text or "")
-                for k in ("确认锁定", "锁定场景", "锁定主体", "锁定风格", "确认风格", "风格锁定", "我确认", "确认：")
-            )
-            implicit_lock_confirmation = any(
-                k in (last_user_text or "")
-                for k in ("继续", "按你给的", "就按这个", "照这个来", "不用确认", "直接生成", "别问了")
-            )
-            # Hard fallback to prevent self-looping: after N turns in the same thread,
-            # stop blocking on lock confirmation and proceed with default lock behavior.
-            if hard_turn_cap > 0 and agent_loop_count >= hard_turn_cap:
-                has_lock_confirmation = True
-            if storyboard_intent and implicit_lock_confirmation:
-                has_lock_confirmation = True
-
-            def _extract_style_lock_from_messages(messages_obj: list | None) -> str | None:
-                if not isinstance(messages_obj, list):
-                    return None
-                for m in reversed(messages_obj):
-                    # Prefer user confirmations
-                    if getattr(m, "type", None) != "human" and getattr(m, "role", None) != "user":
-                        continue
-                    text = str(getattr(m, "content", "") or "")
-                    if not text:
-                        continue
-                    for key in ("确认锁定风格：", "风格锁定：", "锁定风格："):
-                        if key in text:
-                            after = text.split(key, 1)[1].strip()
-                            if not after:
-                                continue
-                            first_line = after.splitlines()[0].strip()
-                            return first_line[:80] if first_line else None
-                return None
+                tool_prompts_text = "".join(f"\n{p}" for p in tool_prompt_parts)
+                safety = _classify_safety(last_user_text or "", tool_prompts_text)
 
-            style_lock = _extract_style_lock_from_messages(state.get("messages") or [])
-            if storyboard_intent and not has_lock_confirmation and not is_story_suggestion_request:
-                # Convert any accidental tool calls into a "plan" with buttons for user confirmation.
-                tool_calls_payload = []
-                if not quick_replies_payload:
-                    if not style_lock:
-                        quick_replies_payload = [
-                            {
-                                "label": "继续（默认锁定：日漫2D）",
-                                "input": "确认锁定风格：日漫2D（干净线稿+赛璐璐）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
-                            },
-                            {
-                                "label": "锁定风格：美漫2D（粗线条）",
-                                "input": "确认锁定风格：美漫2D（粗线条+高对比）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
-                            },
-                            {
-                                "label": "锁定风格：写实真人",
-                                "input": "确认锁定风格：写实真人（电影质感）。场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
-                            },
-                            {
-                                "label": "自定义风格…",
-                                "input": "确认锁定风格：\n- 风格类型（2D日漫/2D美漫/写实/其他）：\n- 线条/材质：\n- 色彩与光影：\n- 镜头语言：\n同时：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（数量不变）。填写后请生成 3x3 九宫格分镜图并连线参考图。",
-                            },
-                        ]
-                    else:
-                        quick_replies_payload = [
-                            {
-                                "label": "继续（按已锁定风格生成分镜）",
-                                "input": f"确认锁定风格：{style_lock}。确认锁定：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（主角数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
-                            },
-                            {
-                                "label": "新增主体…（先出设定图）",
-                                "input": "我要新增主体（角色/产品/关键道具）：\n- 主体1：\n- 主体2：\n要求：先分别生成每个主体的设定图（image），等我确认后再生成九宫格分镜并连线消费这些设定图。",
-                            },
-                            {
-                                "label": "改场景…（先锁定场景图）",
-                                "input": "我想锁定新的主场景：\n- 场景描述：\n要求：先生成一张“场景设定图”（image）给我确认；确认后九宫格分镜必须只在该场景内推进（光线连续），再生成15s视频。",
-                            },
-                            {
-                                "label": "自定义锁定规则…",
-                                "input": "我想自定义锁定规则：\n- 主场景（只能一个）：\n- 允许的过渡场景（可选）：\n- 主体清单（角色/产品/道具）与数量：\n- 禁止事项：\n请按我的规则先补齐必要的设定图，再生成九宫格分镜并继续。",
-                            },
-                        ]
-                if not isinstance(result_text, str) or not result_text.strip():
-                    result_text = "为保证叙事连贯，我需要先锁定“主场景 + 主体数量/清单”。点一个选项确认后，我再在画布里生成九宫格分镜并继续成片。"
-                else:
+                if safety.should_block and (safety.sexual or safety.nudity):
+                    tool_calls_payload = []
+                    quick_replies_payload = list(_QUICK_REPLIES_SAFETY_PG13)
                     result_text = (
-                        result_text.strip()
-                        + "\n\n为保证叙事连贯（画风一致、场景不乱跳、主体不增删），请先确认锁定规则；或直接回复「继续」，我将按默认锁定（日漫2D/单主场景/主体不新增）生成九宫格分镜。"
-                    )
-
-            # Supervisor gate: only allow canvas side-effects when the router approved it for this turn.
-            allow_canvas_tools = state.get("allow_canvas_tools")
-            if allow_canvas_tools is False:
-                tool_calls_payload = []
-                if not quick_replies_payload:
-                    quick_replies_payload = [
-                        {
-                            "label": "继续创作（先选方向）",
-                            "input": "基于我当前项目画布，先给 3 个可选方向（按钮）让我选；我选完你再在画布创建分镜/视频节点。",
-                        },
-                        {
-                            "label": "直接生成（我给具体需求）",
-                            "input": "我想在画布生成一个内容：\n- 类型（图片/分镜/视频）：\n- 主题：\n- 风格：\n- 时长/比例（如需要）：\n请按我的填写创建节点并执行。",
-                        },
-                        {
-                            "label": "只聊不操作画布",
-                            "input": "先不操作画布。请先用一句话问我：我想做什么类型的内容、有什么参考、以及希望的风格/时长。",
-                        },
-                    ]
-                if not isinstance(result_text, str) or not result_text.strip():
-                    result_text = "我先不动画布。你想先聊清楚需求，还是直接点一个选项让我开始执行？"
-
-            # Autopilot: if the model created an image node, also run it immediately.
-            # The frontend can resolve nodeId from label, so we can safely reference labels here.
-            if tool_calls_payload:
-                # If this is a continuation turn and the assistant introduced a NEW character,
-                # require user confirmation before generating storyboard/video.
-                def _canvas_labels_from_context(canvas_context_obj: dict | None) -> set[str]:
-                    if not isinstance(canvas_context_obj, dict):
-                        return set()
-                    nodes_ctx = canvas_context_obj.get("nodes")
-                    if not isinstance(nodes_ctx, list):
-                        return set()
-                    labels: set[str] = set()
-                    for n in nodes_ctx:
-                        if not isinstance(n, dict):
-                            continue
-                        label = n.get("label")
-                        if isinstance(label, str) and label.strip():
-                            labels.add(label.strip())
-                    return labels
-
-                is_continuation_step = (
-                    any(k in (last_user_text or "") for k in ("我选择方向", "自定义续写", "续写"))
-                    and not is_story_suggestion_request
-                )
-                existing_labels = _canvas_labels_from_context(state.get("canvas_context"))
-                created_image_labels: list[str] = []
-                has_storyboard_create = False
-                for c in tool_calls_payload:
-                    if c.get("name") != "createNode":
-                        continue
-                    args = c.get("arguments") or {}
-                    t = args.get("type")
-                    label = args.get("label")
-                    if isinstance(label, str):
-                        label = label.strip()
-                    else:
-                        label = ""
-                    if t == "image" and label:
-                        created_image_labels.append(label)
-                    if t == "image":
-                        cfg = args.get("config") or {}
-                        prompt = cfg.get("prompt") if isinstance(cfg, dict) else ""
-                        hint = f"{label}\n{prompt}"
-                        if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                            has_storyboard_create = True
-
-                # new character heuristic: created image node with label containing "角色" not previously on canvas
-                new_character_labels = [
-                    lbl
-                    for lbl in created_image_labels
-                    if ("角色" in lbl or "character" in lbl.lower())
-                    and lbl not in existing_labels
-                    and not any(k in lbl for k in ("分镜", "九宫格", "storyboard"))
-                ]
-
-                if is_continuation_step and new_character_labels and has_storyboard_create:
-                    # Keep only new character creation + its runNode, drop other canvas ops for now.
-                    kept: list[dict] = []
-                    keep_set = set(new_character_labels)
-                    for c in tool_calls_payload:
-                        if c.get("name") == "createNode":
-                            args = c.get("arguments") or {}
-                            if (args.get("type") == "image") and isinstance(args.get("label"), str):
-                                if args.get("label").strip() in keep_set:
-                                    kept.append(c)
-                            continue
-                        if c.get("name") == "runNode":
-                            args = c.get("arguments") or {}
-                            node_id = args.get("nodeId")
-                            if isinstance(node_id, str) and node_id.strip() in keep_set:
-                                kept.append(c)
-                            continue
-                    tool_calls_payload = kept
-                    # Ask user to confirm character result before proceeding.
-                    quick_replies_payload = [
-                        {
-                            "label": "角色OK，继续分镜",
-                            "input": "新角色我确认OK。请把新角色纳入同一项目设定，基于已有剧情续写下一段，并生成九宫格分镜（image）再连接到15s视频（composeVideo）。",
-                        },
-                        {
-                            "label": "重做这个角色",
-                            "input": "这个新角色不满意。请保持同一角色定位与风格，重做 3 个版本给我选（同一个 image 节点出 3 张即可）。",
-                        },
-                        {
-                            "label": "不要新角色",
-                            "input": "不要新增角色了。请只用现有角色基于已有剧情续写，并生成九宫格分镜与15s视频。",
-                        },
-                    ]
-                    result_text = "我先为续写新增了一个角色设定图。你确认角色外观后，我再继续生成续写分镜。"
-
-                # Normalize image creation: prefer `image` over `textToImage` to match the canvas UX.
-                for call in tool_calls_payload:
-                    if call.get("name") != "createNode":
-                        continue
-                    args = call.get("arguments") or {}
-                    node_type = args.get("type")
-                    if node_type != "textToImage":
-                        continue
-                    args["type"] = "image"
-                    cfg = args.get("config")
-                    if isinstance(cfg, dict) and cfg.get("kind") == "textToImage":
-                        cfg["kind"] = "image"
-
-                # Normalize composeVideo: ensure the node has a usable `prompt`.
-                for call in tool_calls_payload:
-                    if call.get("name") != "createNode":
-                        continue
-                    args = call.get("arguments") or {}
-                    node_type = args.get("type")
-                    if node_type != "composeVideo":
-                        continue
-                    cfg = args.get("config")
-                    if not isinstance(cfg, dict):
-                        continue
-                    # Enforce single-run duration constraint: 10–15 seconds.
-                    # If the model requested a longer duration, clamp to 15s (and let the UX create additional segments).
-                    try:
-                        raw_dur = cfg.get("durationSeconds") if cfg.get("durationSeconds") is not None else cfg.get("duration")
-                        if isinstance(raw_dur, (int, float)):
-                            requested = float(raw_dur)
-                            if requested < 10:
-                                cfg["durationSeconds"] = 10
-                            elif requested > 15:
-                                cfg["durationSeconds"] = 15
-                                # Add a gentle hint so the user can continue with Part 2, without forcing extra nodes.
-                                if isinstance(cfg.get("prompt"), str) and "分段" not in cfg["prompt"]:
-                                    cfg["prompt"] = (
-                                        cfg["prompt"].rstrip()
-                                        + "\n\n约束：本次为第1段（<=15秒）。如需更长成片，请分段生成第2段/第3段。"
-                                    )
-                            else:
-                                cfg["durationSeconds"] = int(round(requested))
-                    except Exception:
-                        pass
-                    prompt_val = cfg.get("prompt")
-                    if isinstance(prompt_val, str) and prompt_val.strip():
-                        continue
-                    if isinstance(cfg.get("shots"), list) or isinstance(cfg.get("characters"), list):
-                        coerced = _composevideo_prompt_from_structured_config(cfg)
-                        if coerced:
-                            cfg["prompt"] = coerced
-
-                # Storyboard workflow: prefer "九宫格分镜图(image) -> composeVideo" (single reference image).
-                # Note: users may ask for "短片/宣传片/产品介绍" without mentioning "分镜/九宫格";
-                # we infer storyboard intent from tool calls as well to keep continuity and auto-connect references.
-                wants_storyboard_by_user = any(
-                    kw in (last_user_text or "")
-                    for kw in ("分镜", "故事板", "storyboard", "九宫格", "15s")
-                )
-                has_compose_video = any(
-                    c.get("name") == "createNode"
-                    and (c.get("arguments") or {}).get("type") == "composeVideo"
-                    for c in tool_calls_payload
-                )
-                storyboard_image_label = None
-                storyboard_image_prompt = None
-                for c in tool_calls_payload:
-                    if c.get("name") != "createNode":
-                        continue
-                    args = c.get("arguments") or {}
-                    if args.get("type") != "image":
-                        continue
-                    cfg = args.get("config") or {}
-                    prompt = cfg.get("prompt") if isinstance(cfg, dict) else None
-                    label = args.get("label")
-                    if isinstance(label, str) and label.strip():
-                        label = label.strip()
-                    else:
-                        label = None
-                    hint = (label or "") + "\n" + (prompt or "")
-                    if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                        storyboard_image_label = label
-                        storyboard_image_prompt = prompt if isinstance(prompt, str) else None
-                        break
-
-                wants_storyboard = wants_storyboard_by_user or bool(storyboard_image_label)
-
-                # If we are creating a storyboard grid image, connect existing character/reference images
-                # (already generated on canvas) as upstream inputs BEFORE running the storyboard node.
-                def _pick_reference_image_labels_from_canvas_context(
-                    canvas_context_obj: dict | None, storyboard_label: str
-                ) -> list[str]:
-                    if not isinstance(canvas_context_obj, dict):
-                        return []
-                    nodes_ctx = canvas_context_obj.get("nodes")
-                    if not isinstance(nodes_ctx, list) or not nodes_ctx:
-                        return []
-                    # 1) Prefer the most recent successful storyboard image as continuity anchor (previous episode/segment).
-                    storyboard_anchor: str | None = None
-                    for n in reversed(nodes_ctx):
-                        if not isinstance(n, dict):
-                            continue
-                        label = n.get("label")
-                        if not isinstance(label, str) or not label.strip():
-                            continue
-                        label = label.strip()
-                        if label == storyboard_label:
-                            continue
-                        kind = n.get("kind") or n.get("type")
-                        if kind not in ("image", "textToImage", "mosaic"):
-                            continue
-                        if n.get("status") != "success":
-                            continue
-                        image_url = n.get("imageUrl")
-                        if not isinstance(image_url, str) or not image_url.strip():
-                            continue
-                        hint = f"{label}\n{n.get('promptPreview') or ''}"
-                        if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                            storyboard_anchor = label
-                            break
-
-                    # 2) Fill remaining slots with subject anchors (characters/products/key props),
-                    # excluding storyboard/video nodes to avoid over-weighting structure over subject identity.
-                    candidates: list[tuple[int, int, str]] = []
-                    for idx, n in enumerate(nodes_ctx):
-                        if not isinstance(n, dict):
-                            continue
-                        label = n.get("label")
-                        if not isinstance(label, str) or not label.strip():
-                            continue
-                        label = label.strip()
-                        if label == storyboard_label:
-                            continue
-                        kind = n.get("kind") or n.get("type")
-                        if kind not in ("image", "textToImage", "mosaic"):
-                            continue
-                        if n.get("status") != "success":
-                            continue
-                        image_url = n.get("imageUrl")
-                        if not isinstance(image_url, str) or not image_url.strip():
-                            continue
-                        if any(k in label for k in ("分镜", "九宫格", "storyboard", "视频", "15s视频")):
-                            continue
-                        score = 0
-                        if any(k in label for k in ("角色", "设定", "立绘", "主视觉", "character", "design")):
-                            score += 3
-                        # Products / key props hints
-                        if any(k in label for k in ("产品", "道具", "物件", "prop", "product")):
-                            score += 2
-                        if any(k in label.lower() for k in ("fox", "bunny", "rabbit")) or any(
-                            k in label for k in ("狐狸", "兔子")
-                        ):
-                            score += 2
-                        candidates.append((score, idx, label))
-                    candidates.sort(key=lambda t: (t[0], t[1]), reverse=True)
-                    picked: list[str] = []
-                    if storyboard_anchor:
-                        picked.append(storyboard_anchor)
-                    for _, _, label in candidates:
-                        if label in picked:
-                            continue
-                        picked.append(label)
-                        if len(picked) >= 3:
-                            break
-                    return picked[:3]
-
-                if wants_storyboard and isinstance(storyboard_image_label, str) and storyboard_image_label:
-                    canvas_context_obj = state.get("canvas_context")
-                    reference_labels = _pick_reference_image_labels_from_canvas_context(
-                        canvas_context_obj, storyboard_image_label
+                        "内容安全检查判定为需要先降级到 PG-13（不露骨、不裸露）。"
+                        "我不会生成露骨色情内容；可以先把表达改成含蓄、电影化暗示再继续做分镜/视频。点一个按钮继续。"
                     )
-                    # Inject a default continuity constraint into the storyboard prompt:
-                    # - panel-to-panel bridge frame (end pose/composition repeats at next start)
-                    # - if previous storyboard is among references, continue from its final panel
+                elif safety.should_sanitize and (safety.sexual or safety.nudity):
+                    # Sanitize prompts and add safety negatives, but do not hard-block the whole turn.
                     try:
-                        for c in tool_calls_payload:
+                        for c in tool_calls_payload or []:
                             if c.get("name") != "createNode":
                                 continue
                             args = c.get("arguments") or {}
-                            if args.get("type") != "image":
-                                continue
-                            label = args.get("label")
-                            if not isinstance(label, str) or label.strip() != storyboard_image_label:
-                                continue
                             cfg = args.get("config")
                             if not isinstance(cfg, dict):
                                 continue
-                            prompt_val = cfg.get("prompt")
-                            if not isinstance(prompt_val, str) or not prompt_val.strip():
-                                continue
-                            if "衔接帧" in prompt_val or "bridge frame" in prompt_val.lower():
-                                break
-                            continuity = (
-                                "\n\n连续性要求（很重要）：\n"
-                                "- 九宫格面板之间要有“衔接帧”感觉：面板N的结尾姿态/构图/机位/光线，应与面板N+1的开场保持一致（像同一动作的承接），避免突兀跳切。\n"
-                                "- 如果上游参考里包含上一张九宫格分镜图：请让本次面板1自然承接上一张的面板9（构图/主体位置/光线延续），再继续推进新内容。\n"
-                                "- 场景不要自由切换；主体数量不要在分镜中途增删。\n"
-                            )
-                            cfg["prompt"] = prompt_val.rstrip() + continuity
-                            break
+                            if isinstance(cfg.get("prompt"), str):
+                                cfg["prompt"] = _sanitize_sexual_text(cfg["prompt"])
+                            neg = cfg.get("negativePrompt")
+                            neg_text = neg if isinstance(neg, str) else ""
+                            add_neg = "nude, naked, explicit sex, porn, nipples, genitalia"
+                            if add_neg not in neg_text:
+                                cfg["negativePrompt"] = (neg_text + ("\n" if neg_text else "") + add_neg).strip()
                     except Exception:
                         pass
-                    if reference_labels:
-                        existing_pairs: set[tuple[str, str]] = set()
-                        for c in tool_calls_payload:
-                            if c.get("name") != "connectNodes":
+                elif safety.should_sanitize and (safety.gore or safety.violence):
+                    result_text = _sanitize_violent_text(result_text or "")
+                    try:
+                        for c in tool_calls_payload or []:
+                            if c.get("name") != "createNode":
                                 continue
                             args = c.get("arguments") or {}
-                            src = args.get("sourceNodeId") or args.get("sourceId")
-                            tgt = args.get("targetNodeId") or args.get("targetId")
-                            if isinstance(src, str) and isinstance(tgt, str):
-                                s = src.strip()
-                                t = tgt.strip()
-                                if s and t:
-                                    existing_pairs.add((s, t))
-
-                        create_idx = None
-                        run_idx = None
-                        for i, c in enumerate(tool_calls_payload):
-                            if c.get("name") == "createNode":
-                                args = c.get("arguments") or {}
-                                label = args.get("label")
-                                if isinstance(label, str) and label.strip() == storyboard_image_label:
-                                    create_idx = i
-                                    continue
-                            if c.get("name") == "runNode":
-                                args = c.get("arguments") or {}
-                                node_id = args.get("nodeId")
-                                if isinstance(node_id, str) and node_id.strip() == storyboard_image_label:
-                                    run_idx = i
-                                    break
-                        insert_at = run_idx if run_idx is not None else len(tool_calls_payload)
-                        if create_idx is not None and insert_at <= create_idx:
-                            insert_at = create_idx + 1
-
-                        connect_calls: list[dict] = []
-                        for src_label in reference_labels:
-                            if (src_label, storyboard_image_label) in existing_pairs:
+                            cfg = args.get("config")
+                            if not isinstance(cfg, dict):
                                 continue
-                            connect_calls.append(
-                                {
-                                    "id": f"auto_ref_{src_label}_to_{storyboard_image_label}",
-                                    "name": "connectNodes",
-                                    "arguments": {
-                                        "sourceNodeId": src_label,
-                                        "targetNodeId": storyboard_image_label,
-                                        "sourceHandle": "out-image-wide",
-                                        "targetHandle": "in-image-wide",
-                                    },
-                                }
-                            )
-                        if connect_calls:
-                            tool_calls_payload[insert_at:insert_at] = connect_calls
-
-                if wants_storyboard and storyboard_image_label and not has_compose_video:
-                    video_label = storyboard_image_label.replace("九宫格分镜", "15s视频").replace("分镜", "15s视频")
-                    if video_label == storyboard_image_label:
-                        video_label = f"{storyboard_image_label}-15s视频"
-                    storyboard_hint = ""
-                    if isinstance(storyboard_image_prompt, str) and storyboard_image_prompt.strip():
-                        normalized = "\n".join(
-                            [ln.strip() for ln in storyboard_image_prompt.strip().splitlines() if ln.strip()]
-                        )
-                        if len(normalized) > 1200:
-                            normalized = normalized[:1200].rstrip() + "…"
-                        storyboard_hint = (
-                            "\n\n分镜补充（来自九宫格分镜的镜头描述，用于动作/镜头节奏对齐；以参考图为准）：\n"
-                            + normalized
-                        )
-                    video_prompt = (
-                        "根据上游参考图片（九宫格分镜图）生成一个15秒的二维动画视频：\n"
-                        "- 画面风格/角色外观严格跟随参考图；不要改变角色造型与配色。\n"
-                        "- 按参考图的镜头节奏推进（从1到9），镜头之间自然衔接；保持同一场景光线连续。\n"
-                        "- 不要出现任何可读文字/水印/Logo。\n"
-                        "- 输出16:9，动作清晰，镜头稳定，节奏温暖治愈。"
-                        + storyboard_hint
-                    )
-                    tool_calls_payload.append(
-                        {
-                            "id": f"auto_create_video_{video_label}",
-                            "name": "createNode",
-                            "arguments": {
-                                "type": "composeVideo",
-                                "label": video_label,
-                                "config": {
-                                    "kind": "composeVideo",
-                                    "durationSeconds": 15,
-                                    "aspectRatio": "16:9",
-                                    "prompt": video_prompt,
-                                },
-                            },
-                        }
-                    )
-                    tool_calls_payload.append(
-                        {
-                            "id": f"auto_connect_{storyboard_image_label}_to_{video_label}",
-                            "name": "connectNodes",
-                            "arguments": {
-                                "sourceNodeId": storyboard_image_label,
-                                "targetNodeId": video_label,
-                                "sourceHandle": "out-image",
-                                "targetHandle": "in-image",
-                            },
-                        }
-                    )
-
-                # General continuity: if the user asks to base new content on existing results (基于/续写/同款/延展),
-                # ensure newly created image nodes are connected to a relevant upstream image before running.
-                reference_intent = any(
-                    kw in (last_user_text or "")
-                    for kw in ("基于", "同款", "同风格", "沿用", "续写", "延展", "变体", "参考", "保持一致")
+                            if isinstance(cfg.get("prompt"), str):
+                                cfg["prompt"] = _sanitize_violent_text(cfg["prompt"])
+                            neg = cfg.get("negativePrompt")
+                            neg_text = neg if isinstance(neg, str) else ""
+                            add_neg = "gore, dismemberment, intestines, brains, blood splatter close-up, explicit violence, torture porn, nude, explicit sex"
+                            if add_neg not in neg_text:
+                                cfg["negativePrompt"] = (neg_text + ("\n" if neg_text else "") + add_neg).strip()
+                    except Exception:
+                        pass
+                _user_text = last_user_text or ""
+                is_story_suggestion_request = bool(
+                    _CONTINUATION_RE.search(_user_text)
+                    and _SUGGEST_VERBS_RE.search(_user_text)
+                    and not _STORY_KIND_RE.search(_user_text)
                 )
 
-                def _pick_latest_success_image_label(canvas_context_obj: dict | None) -> str | None:
-                    if not isinstance(canvas_context_obj, dict):
+                if is_story_suggestion_request and "tapcanvas_actions" not in (result_text or ""):
+                    # Prevent unintended canvas actions triggered by the model.
+                    tool_calls_payload = []
+                    quick_replies_payload = list(_QUICK_REPLIES_STORY_DIRECTIONS)
+                    result_text = "给你 3 个续写方向，点一个我就按这个继续写；也可以选“自定义方向”把你想要的走向填进去。"
+
+                # Storyboard/video continuity gate:
+                # To avoid abrupt scene drift and accidental new subjects, require an explicit "lock" confirmation
+                # before creating storyboard/video nodes, unless the user already confirmed.
+                storyboard_intent = bool(_STORYBOARD_INTENT_RE.search(last_user_text or ""))
+                has_lock_confirmation = bool(_LOCK_CONFIRM_RE.search(last_user_text or ""))
+                implicit_lock_confirmation = bool(_IMPLICIT_LOCK_RE.search(last_user_text or ""))
+                # Hard fallback to prevent self-looping: after N turns in the same thread,
+                # stop blocking on lock confirmation and proceed with default lock behavior.
+                if hard_turn_cap > 0 and agent_loop_count >= hard_turn_cap:
+                    has_lock_confirmation = True
+                if storyboard_intent and implicit_lock_confirmation:
+                    has_lock_confirmation = True
+
+                def _extract_style_lock_from_messages(messages_obj: list | None) -> str | None:
+                    if not isinstance(messages_obj, list):
                         return None
-                    nodes_ctx = canvas_context_obj.get("nodes")
-                    if not isinstance(nodes_ctx, list) or not nodes_ctx:
-                        return None
-                    # iterate from latest to oldest
-                    for n in reversed(nodes_ctx):
-                        if not isinstance(n, dict):
-                            continue
-                        kind = n.get("kind") or n.get("type")
-                        if kind not in ("image", "textToImage", "mosaic"):
+                    for m in reversed(messages_obj):
+                        # Prefer user confirmations
+                        if getattr(m, "type", None) != "human" and getattr(m, "role", None) != "user":
                             continue
-                        if n.get("status") != "success":
+                        text = str(getattr(m, "content", "") or "")
+                        if not text:
                             continue
-                        label = n.get("label")
-                        if not isinstance(label, str) or not label.strip():
-                            continue
-                        label = label.strip()
-                        if any(k in label for k in ("分镜", "九宫格", "storyboard")):
-                            continue
-                        image_url = n.get("imageUrl")
-                        if not isinstance(image_url, str) or not image_url.strip():
-                            continue
-                        return label
+                        for key in ("确认锁定风格：", "风格锁定：", "锁定风格："):
+                            if key in text:
+                                after = text.split(key, 1)[1].strip()
+                                if not after:
+                                    continue
+                                first_line = after.splitlines()[0].strip()
+                                return first_line[:80] if first_line else None
                     return None
 
-                if reference_intent:
-                    canvas_context_obj = state.get("canvas_context")
-                    upstream_label = _pick_latest_success_image_label(canvas_context_obj)
-                    if upstream_label:
-                        # Build a set of (source,target) already connected in this payload to avoid duplicates.
-                        existing_pairs: set[tuple[str, str]] = set()
-                        existing_targets: set[str] = set()
+                style_lock = _extract_style_lock_from_messages(state.get("messages") or [])
+                if storyboard_intent and not has_lock_confirmation and not is_story_suggestion_request:
+                    # Convert any accidental tool calls into a "plan" with buttons for user confirmation.
+                    tool_calls_payload = []
+                    if not quick_replies_payload:
+                        if not style_lock:
+                            quick_replies_payload = list(_QUICK_REPLIES_STYLE_LOCK_DEFAULT)
+                        else:
+                            quick_replies_payload = [
+                                {
+                                    "label": "继续（按已锁定风格生成分镜）",
+                                    "input": f"确认锁定风格：{style_lock}。确认锁定：场景沿用当前项目主场景（光线连续，不自由换景）；主体不新增（主角数量不变）。请把剧情压缩成 3x3 九宫格分镜图，并把参考图全部连到分镜节点上。",
+                                },
+                                *_QUICK_REPLIES_STYLE_LOCK_TAIL,
+                            ]
+                    if not isinstance(result_text, str) or not result_text.strip():
+                        result_text = "为保证叙事连贯，我需要先锁定“主场景 + 主体数量/清单”。点一个选项确认后，我再在画布里生成九宫格分镜并继续成片。"
+                    else:
+                        result_text = (
+                            result_text.strip()
+                            + "\n\n为保证叙事连贯（画风一致、场景不乱跳、主体不增删），请先确认锁定规则；或直接回复「继续」，我将按默认锁定（日漫2D/单主场景/主体不新增）生成九宫格分镜。"
+                        )
+
+                # Autopilot: if the model created an image node, also run it immediately.
+                # The frontend can resolve nodeId from label, so we can safely reference labels here.
+                if tool_calls_payload:
+                    # If this is a continuation turn and the assistant introduced a NEW character,
+                    # require user confirmation before generating storyboard/video.
+                    is_continuation_step = bool(
+                        _DIRECTION_CHOICE_RE.search(last_user_text or "")
+                    ) and not is_story_suggestion_request
+                    existing_labels = _canvas_label_set(canvas_context)
+                    created_image_labels: list[str] = []
+                    has_storyboard_create = False
+                    for c in tool_calls_payload:
+                        if c.get("name") != "createNode":
+                            continue
+                        args = c.get("arguments") or {}
+                        t = args.get("type")
+                        label = _str_arg(args, "label") or ""
+                        if t == "image" and label:
+                            created_image_labels.append(label)
+                        if t == "image":
+                            cfg = args.get("config") or {}
+                            prompt = cfg.get("prompt") if isinstance(cfg, dict) else ""
+                            hint = f"{label}\n{prompt}"
+                            if _STORYBOARD_HINT_RE.search(hint):
+                                has_storyboard_create = True
+
+                    # new character heuristic: created image node with label containing "角色" not previously on canvas
+                    new_character_labels = [
+                        lbl
+                        for lbl in created_image_labels
+                        if ("角色" in lbl or "character" in lbl.lower())
+                        and lbl not in existing_labels
+                        and not _STORYBOARD_LABEL_RE.search(lbl)
+                    ]
+
+                    if is_continuation_step and new_character_labels and has_storyboard_create:
+                        # Keep only new character creation + its runNode, drop other canvas ops for now.
+                        kept: list[dict] = []
+                        keep_set = set(new_character_labels)
                         for c in tool_calls_payload:
-                            if c.get("name") != "connectNodes":
-                                continue
-                            args = c.get("arguments") or {}
-                            src = args.get("sourceNodeId") or args.get("sourceId")
-                            tgt = args.get("targetNodeId") or args.get("targetId")
-                            if isinstance(src, str) and isinstance(tgt, str):
-                                s = src.strip()
-                                t = tgt.strip()
-                                if s and t:
-                                    existing_pairs.add((s, t))
-                                    existing_targets.add(t)
-
-                        # For each newly created image node, if it has no inbound connection yet, add one.
-                        for idx, c in enumerate(list(tool_calls_payload)):
-                            if c.get("name") != "createNode":
+                            if c.get("name") == "createNode":
+                                args = c.get("arguments") or {}
+                                if args.get("type") == "image" and _str_arg(args, "label") in keep_set:
+                                    kept.append(c)
                                 continue
-                            args = c.get("arguments") or {}
-                            if args.get("type") != "image":
+                            if c.get("name") == "runNode":
+                                args = c.get("arguments") or {}
+                                if _str_arg(args, "nodeId") in keep_set:
+                                    kept.append(c)
                                 continue
-                            label = args.get("label")
-                            if not isinstance(label, str) or not label.strip():
+                        tool_calls_payload = kept
+                        # Ask user to confirm character result before proceeding.
+                        quick_replies_payload = list(_QUICK_REPLIES_CHARACTER_CONFIRM)
+                        result_text = "我先为续写新增了一个角色设定图。你确认角色外观后，我再继续生成续写分镜。"
+
+                    # Single normalization pass over the tool calls: rename
+                    # textToImage -> image, clamp/coerce composeVideo configs, and
+                    # collect the storyboard/video facts the later workflow checks
+                    # need. One loop keeps the args/config dicts hot instead of four
+                    # sequential scans.
+                    wants_storyboard_by_user = bool(_WANTS_STORYBOARD_RE.search(last_user_text or ""))
+                    has_compose_video = False
+                    storyboard_image_label = None
+                    storyboard_image_prompt = None
+                    for call in tool_calls_payload:
+                        if call.get("name") != "createNode":
+                            continue
+                        args = call.get("arguments") or {}
+                        node_type = args.get("type")
+                        if node_type == "textToImage":
+                            # Prefer `image` over `textToImage` to match the canvas UX.
+                            node_type = args["type"] = "image"
+                            cfg = args.get("config")
+                            if isinstance(cfg, dict) and cfg.get("kind") == "textToImage":
+                                cfg["kind"] = "image"
+                        if node_type == "composeVideo":
+                            has_compose_video = True
+                            cfg = args.get("config")
+                            if not isinstance(cfg, dict):
                                 continue
-                            target_label = label.strip()
-                            if target_label == upstream_label:
+                            # Enforce single-run duration constraint: 10–15 seconds.
+                            # If the model requested a longer duration, clamp to 15s (and let the UX create additional segments).
+                            try:
+                                raw_dur = cfg.get("durationSeconds") if cfg.get("durationSeconds") is not None else cfg.get("duration")
+                                if isinstance(raw_dur, (int, float)):
+                                    requested = float(raw_dur)
+                                    if requested < 10:
+                                        cfg["durationSeconds"] = 10
+                                    elif requested > 15:
+                                        cfg["durationSeconds"] = 15
+                                        # Add a gentle hint so the user can continue with Part 2, without forcing extra nodes.
+                                        if isinstance(cfg.get("prompt"), str) and "分段" not in cfg["prompt"]:
+                                            cfg["prompt"] = (
+                                                cfg["prompt"].rstrip()
+                                                + "\n\n约束：本次为第1段（<=15秒）。如需更长成片，请分段生成第2段/第3段。"
+                                            )
+                                    else:
+                                        cfg["durationSeconds"] = int(round(requested))
+                            except Exception:
+                                pass
+                            prompt_val = cfg.get("prompt")
+                            if isinstance(prompt_val, str) and prompt_val.strip():
                                 continue
-                            # Skip storyboard grid; it has its own multi-reference logic above.
+                            if isinstance(cfg.get("shots"), list) or isinstance(cfg.get("characters"), list):
+                                coerced = _composevideo_prompt_from_structured_config(cfg)
+                                if coerced:
+                                    cfg["prompt"] = coerced
+                            continue
+                        if node_type == "image" and storyboard_image_label is None:
+                            # Storyboard workflow: prefer "九宫格分镜图(image) -> composeVideo" (single reference image).
+                            # Note: users may ask for "短片/宣传片/产品介绍" without mentioning "分镜/九宫格";
+                            # we infer storyboard intent from tool calls as well to keep continuity and auto-connect references.
                             cfg = args.get("config") or {}
-                            prompt = cfg.get("prompt") if isinstance(cfg, dict) else ""
-                            hint = f"{target_label}\n{prompt}"
-                            if any(k in hint for k in ("九宫格", "3x3", "分镜", "storyboard")):
-                                continue
-                            if target_label in existing_targets:
-                                continue
-                            if (upstream_label, target_label) in existing_pairs:
-                                continue
-
-                            # Insert before the runNode(target) if present, otherwise right after createNode.
-                            insert_at = idx + 1
-                            for j in range(idx + 1, len(tool_calls_payload)):
-                                tc = tool_calls_payload[j]
-                                if tc.get("name") != "runNode":
+                            prompt = cfg.get("prompt") if isinstance(cfg, dict) else None
+                            label = args.get("label")
+                            if isinstance(label, str) and label.strip():
+                                label = label.strip()
+                            else:
+                                label = None
+                            hint = (label or "") + "\n" + (prompt or "")
+                            if _STORYBOARD_HINT_RE.search(hint):
+                                storyboard_image_label = label
+                                storyboard_image_prompt = prompt if isinstance(prompt, str) else None
+
+                    wants_storyboard = wants_storyboard_by_user or bool(storyboard_image_label)
+                    payload_idx = _index_tool_calls(tool_calls_payload)
+                    valid_image_nodes = _filter_image_nodes(canvas_context)
+
+                    # If we are creating a storyboard grid image, connect existing character/reference images
+                    # (already generated on canvas) as upstream inputs BEFORE running the storyboard node.
+
+                    if wants_storyboard and isinstance(storyboard_image_label, str) and storyboard_image_label:
+                        reference_labels = _pick_reference_image_labels(
+                            valid_image_nodes, storyboard_image_label
+                        )
+                        # Inject a default continuity constraint into the storyboard prompt:
+                        # - panel-to-panel bridge frame (end pose/composition repeats at next start)
+                        # - if previous storyboard is among references, continue from its final panel
+                        try:
+                            for c in tool_calls_payload:
+                                if c.get("name") != "createNode":
+                                    continue
+                                args = c.get("arguments") or {}
+                                if args.get("type") != "image":
+                                    continue
+                                label = args.get("label")
+                                if not isinstance(label, str) or label.strip() != storyboard_image_label:
+                                    continue
+                                cfg = args.get("config")
+                                if not isinstance(cfg, dict):
                                     continue
-                                nid = (tc.get("arguments") or {}).get("nodeId")
-                                if isinstance(nid, str) and nid.strip() == target_label:
-                                    insert_at = j
+                                prompt_val = cfg.get("prompt")
+                                if not isinstance(prompt_val, str) or not prompt_val.strip():
+                                    continue
+                                if "衔接帧" in prompt_val or "bridge frame" in prompt_val.lower():
                                     break
-                            tool_calls_payload.insert(
-                                insert_at,
-                                {
-                                    "id": f"auto_ref_{upstream_label}_to_{target_label}",
-                                    "name": "connectNodes",
-                                    "arguments": {
-                                        "sourceNodeId": upstream_label,
-                                        "targetNodeId": target_label,
-                                        "sourceHandle": "out-image",
-                                        "targetHandle": "in-image",
+                                continuity = (
+                                    "\n\n连续性要求（很重要）：\n"
+                                    "- 九宫格面板之间要有“衔接帧”感觉：面板N的结尾姿态/构图/机位/光线，应与面板N+1的开场保持一致（像同一动作的承接），避免突兀跳切。\n"
+                                    "- 如果上游参考里包含上一张九宫格分镜图：请让本次面板1自然承接上一张的面板9（构图/主体位置/光线延续），再继续推进新内容。\n"
+                                    "- 场景不要自由切换；主体数量不要在分镜中途增删。\n"
+                                )
+                                cfg["prompt"] = prompt_val.rstrip() + continuity
+                                break
+                        except Exception:
+                            pass
+                        if reference_labels:
+                            existing_pairs = payload_idx.connect_pairs
+                            create_idx = payload_idx.create_idx_by_label.get(storyboard_image_label)
+                            run_idx = payload_idx.run_idx_by_label.get(storyboard_image_label)
+                            insert_at = run_idx if run_idx is not None else len(tool_calls_payload)
+                            if create_idx is not None and insert_at <= create_idx:
+                                insert_at = create_idx + 1
+
+                            connect_calls = [
+                                _make_connect(
+                                    f"auto_ref_{src_label}_to_{storyboard_image_label}",
+                                    src_label,
+                                    storyboard_image_label,
+                                    *_REF_HANDLES,
+                                )
+                                for src_label in reference_labels
+                                if (src_label, storyboard_image_label) not in existing_pairs
+                            ]
+                            if connect_calls:
+                                tool_calls_payload[insert_at:insert_at] = connect_calls
+                                for src_label in reference_labels:
+                                    payload_idx.connect_pairs.add((src_label, storyboard_image_label))
+                                    payload_idx.connect_targets.add(storyboard_image_label)
+                                shift = len(connect_calls)
+                                for lbl, i in payload_idx.create_idx_by_label.items():
+                                    if i >= insert_at:
+                                        payload_idx.create_idx_by_label[lbl] = i + shift
+                                for lbl, i in payload_idx.run_idx_by_label.items():
+                                    if i >= insert_at:
+                                        payload_idx.run_idx_by_label[lbl] = i + shift
+
+                    if wants_storyboard and storyboard_image_label and not has_compose_video:
+                        video_label = _VIDEO_LABEL_RE.sub("15s视频", storyboard_image_label)
+                        if video_label == storyboard_image_label:
+                            video_label = f"{storyboard_image_label}-15s视频"
+                        storyboard_hint = ""
+                        if isinstance(storyboard_image_prompt, str) and storyboard_image_prompt.strip():
+                            normalized = _LINE_EDGE_WS_RE.sub(
+                                "\n", storyboard_image_prompt.strip()
+                            ).strip("\n")
+                            if len(normalized) > 1200:
+                                normalized = normalized[:1200].rstrip() + "…"
+                            storyboard_hint = (
+                                "\n\n分镜补充（来自九宫格分镜的镜头描述，用于动作/镜头节奏对齐；以参考图为准）：\n"
+                                + normalized
+                            )
+                        video_prompt = _VIDEO_PROMPT_TMPL + storyboard_hint
+                        tool_calls_payload.append(
+                            {
+                                "id": f"auto_create_video_{video_label}",
+                                "name": "createNode",
+                                "arguments": {
+                                    "type": "composeVideo",
+                                    "label": video_label,
+                                    "config": {
+                                        "kind": "composeVideo",
+                                        "durationSeconds": 15,
+                                        "aspectRatio": "16:9",
+                                        "prompt": video_prompt,
                                     },
                                 },
+                            }
+                        )
+                        tool_calls_payload.append(
+                            _make_connect(
+                                f"auto_connect_{storyboard_image_label}_to_{video_label}",
+                                storyboard_image_label,
+                                video_label,
+                                "out-image",
+                                "in-image",
                             )
-                            existing_targets.add(target_label)
-
-                # If this response sets up an image->video storyboard workflow, avoid prematurely running video.
-                created_image_labels: set[str] = set()
-                created_video_labels: set[str] = set()
-                for call in tool_calls_payload:
-                    if call.get("name") != "createNode":
-                        continue
-                    args = call.get("arguments") or {}
-                    node_type = args.get("type")
-                    label = args.get("label")
-                    if not isinstance(label, str) or not label.strip():
-                        continue
-                    if node_type in ("image", "textToImage"):
-                        created_image_labels.add(label.strip())
-                    if node_type == "composeVideo":
-                        created_video_labels.add(label.strip())
-
-                if created_image_labels and created_video_labels:
-                    tool_calls_payload[:] = [
-                        c
-                        for c in tool_calls_payload
-                        if not (
-                            c.get("name") == "runNode"
-                            and isinstance((c.get("arguments") or {}).get("nodeId"), str)
-                            and (c.get("arguments") or {}).get("nodeId").strip() in created_video_labels
                         )
-                    ]
+                        payload_idx.created_video_labels.add(video_label)
+                        payload_idx.connect_pairs.add((storyboard_image_label, video_label))
+                        payload_idx.connect_targets.add(video_label)
+
+                    # General continuity: if the user asks to base new content on existing results (基于/续写/同款/延展),
+                    # ensure newly created image nodes are connected to a relevant upstream image before running.
+                    reference_intent = _has_ref_intent(last_user_text or "")
+
+                    if reference_intent and payload_idx.created_image_labels:
+                        upstream_label = _pick_latest_success_image_label(valid_image_nodes)
+                        if upstream_label:
+                            # (source,target) pairs already connected in this payload, to avoid duplicates.
+                            existing_pairs = payload_idx.connect_pairs
+                            existing_targets = payload_idx.connect_targets
+
+                            # For each newly created image node, if it has no inbound connection yet,
+                            # record one; inserts are deferred and applied in a single rebuild so the
+                            # loop never shifts the list it is iterating.
+                            pending_inserts: dict[int, list[dict]] = {}
+                            for idx, c in enumerate(tool_calls_payload):
+                                if c.get("name") != "createNode":
+                                    continue
+                                args = c.get("arguments") or {}
+                                if args.get("type") != "image":
+                                    continue
+                                target_label = _str_arg(args, "label")
+                                if not target_label:
+                                    continue
+                                if target_label == upstream_label:
+                                    continue
+                                # Skip storyboard grid; it has its own multi-reference logic above.
+                                cfg = args.get("config") or {}
+                                prompt = cfg.get("prompt") if isinstance(cfg, dict) else ""
+                                hint = f"{target_label}\n{prompt}"
+                                if _STORYBOARD_HINT_RE.search(hint):
+                                    continue
+                                if (
+                                    target_label in existing_targets
+                                    or (upstream_label, target_label) in existing_pairs
+                                ):
+                                    continue
 
-                created_labels: list[str] = []
-                already_running: set[str] = set()
-                for call in tool_calls_payload:
-                    if call.get("name") == "runNode":
-                        args = call.get("arguments") or {}
-                        node_id = args.get("nodeId")
-                        if isinstance(node_id, str) and node_id.strip():
-                            already_running.add(node_id.strip())
-                    if call.get("name") == "createNode":
-                        args = call.get("arguments") or {}
-                        node_type = args.get("type")
-                        label = args.get("label")
-                        if (
-                            node_type in ("image", "textToImage")
-                            and isinstance(label, str)
-                            and label.strip()
-                        ):
-                            created_labels.append(label.strip())
-                for label in created_labels:
-                    if label in already_running:
-                        continue
-                    tool_calls_payload.append(
-                        {
-                            "id": f"auto_run_{label}",
-                            "name": "runNode",
-                            "arguments": {"nodeId": label},
-                        }
-                    )
+                                # Insert before the runNode(target) if present, otherwise right after createNode.
+                                run_idx = payload_idx.run_idx_by_label.get(target_label)
+                                insert_at = run_idx if run_idx is not None and run_idx > idx else idx + 1
+                                pending_inserts.setdefault(insert_at, []).append(
+                                    _make_connect(
+                                        f"auto_ref_{upstream_label}_to_{target_label}",
+                                        upstream_label,
+                                        target_label,
+                                        "out-image",
+                                        "in-image",
+                                    )
+                                )
+                                payload_idx.connect_pairs.add((upstream_label, target_label))
+                                existing_targets.add(target_label)
+                            if pending_inserts:
+                                new_payload: list[dict] = []
+                                for i, c in enumerate(tool_calls_payload):
+                                    inserted = pending_inserts.get(i)
+                                    if inserted:
+                                        new_payload.extend(inserted)
+                                    new_payload.append(c)
+                                tail = pending_inserts.get(len(tool_calls_payload))
+                                if tail:
+                                    new_payload.extend(tail)
+                                tool_calls_payload[:] = new_payload
+
+                    # If this response sets up an image->video storyboard workflow, avoid prematurely running video.
+                    if payload_idx.created_image_labels and payload_idx.created_video_labels:
+                        blocked = payload_idx.created_video_labels
+
+                        def _is_blocked_run(c: dict) -> bool:
+                            if c.get("name") != "runNode":
+                                return False
+                            nid = _str_arg(c.get("arguments") or {}, "nodeId")
+                            return nid in blocked
+
+                        tool_calls_payload[:] = [
+                            c for c in tool_calls_payload if not _is_blocked_run(c)
+                        ]
+                        payload_idx.run_node_ids -= blocked
+
+                    already_running = payload_idx.run_node_ids
+                    for label in payload_idx.created_image_order:
+                        if label in already_running:
+                            continue
+                        tool_calls_payload.append(
+                            {
+                                "id": f"auto_run_{label}",
+                                "name": "runNode",
+                                "arguments": {"nodeId": label},
+                            }
+                        )
             result = AIMessage(content=result_text)
         except ValueError as exc:
             debug_openai_error("finalize_answer", exc)
@@ -2264,14 +3328,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
             result = AIMessage(content="无法生成最终答案：运行时异常。")
     else:
         # init Reasoning Model, default to Gemini 2.5 Flash
-        require_gemini_key()
-        llm = ChatGoogleGenerativeAI(
-            model=reasoning_model,
-            temperature=0,
-            max_retries=2,
-            api_key=os.getenv("GEMINI_API_KEY"),
-        )
-        result = llm.invoke(formatted_prompt)
+        result = _get_gemini_llm(reasoning_model, 0).invoke(formatted_prompt)
 
     # Replace the short urls with the original urls and add all used urls to the sources_gathered
     unique_sources = []
@@ -2292,18 +3349,17 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
                 name = call.get("name")
                 args = call.get("arguments") or {}
                 if name == "createNode":
-                    label = args.get("label")
+                    label = _str_arg(args, "label")
                     node_type = args.get("type")
-                    if isinstance(label, str) and label.strip():
-                        label = label.strip()
-                        if node_type in ("image", "textToImage"):
+                    if label:
+                        if node_type in _IMAGE_CREATE_TYPES:
                             created_images.append(label)
                         if node_type == "composeVideo":
                             created_videos.append(label)
                 if name == "runNode":
-                    node_id = args.get("nodeId")
-                    if isinstance(node_id, str) and node_id.strip():
-                        ran_nodes.add(node_id.strip())
+                    node_id = _str_arg(args, "nodeId")
+                    if node_id:
+                        ran_nodes.add(node_id)
 
             if not quick_replies_payload:
                 actions: list[dict] = []
@@ -2387,6 +3443,7 @@ def finalize_answer(state: OverallState, config: RunnableConfig):
 builder = StateGraph(OverallState, config_schema=Configuration)
 
 # Define the nodes we will cycle between (web_research removed for animation/video focus)
+builder.add_node("prepare_transcript", prepare_transcript)
 builder.add_node("select_role", select_role)
 
 
@@ -2405,7 +3462,7 @@ def kb_retrieve(state: OverallState, config: RunnableConfig) -> OverallState:
         return {}
 
     # Use the latest user message as the query.
-    query = get_research_topic(state.get("messages") or [])
+    query = _research_topic(state)
     if not isinstance(query, str):
         query = ""
     query = query.strip()
@@ -2424,9 +3481,14 @@ def kb_retrieve(state: OverallState, config: RunnableConfig) -> OverallState:
 builder.add_node("direct_answer", direct_answer)
 builder.add_node("kb_retrieve", kb_retrieve)
 
-# Entrypoint: role selection then direct answer (no web search)
-builder.add_edge(START, "select_role")
-builder.add_edge("select_role", "kb_retrieve")
+# Entrypoint: role selection and KB retrieval are independent (both read only the
+# incoming messages/config), so run them as parallel branches and join at
+# direct_answer. The list channels (search_query / web_research_result /
+# sources_gathered) merge via their operator.add reducers.
+builder.add_edge(START, "prepare_transcript")
+builder.add_edge("prepare_transcript", "select_role")
+builder.add_edge("prepare_transcript", "kb_retrieve")
+builder.add_edge("select_role", "direct_answer")
 builder.add_edge("kb_retrieve", "direct_answer")
 builder.add_edge("direct_answer", END)
 
@@ -1,9 +1,43 @@
-from datetime import datetime
+import string
+from datetime import date
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1)
+def _formatted_date(ordinal: int) -> str:
+    return date.fromordinal(ordinal).strftime("%B %d, %Y")
 
 
 # Get current date in a readable format
 def get_current_date():
-    return datetime.now().strftime("%B %d, %Y")
+    # Cached per day: strftime is locale-sensitive and shows up when every
+    # prompt render asks for the date; the ordinal key invalidates at midnight.
+    return _formatted_date(date.today().toordinal())
+
+
+_FORMATTER = string.Formatter()
+
+
+@lru_cache(maxsize=None)
+def _template_parts(template: str) -> tuple:
+    """Parse a format string once into (literal, field, spec, conversion) tuples."""
+    return tuple(_FORMATTER.parse(template))
+
+
+def render_prompt(template: str, **values) -> str:
+    """Render a prompt template without re-parsing the format string per call.
+
+    Equivalent to template.format(**values) for the plain {name} placeholders
+    these prompts use.
+    """
+    out: list[str] = []
+    for literal, field, spec, _conv in _template_parts(template):
+        if literal:
+            out.append(literal)
+        if field is not None:
+            value = values[field]
+            out.append(value if isinstance(value, str) else format(value, spec or ""))
+    return "".join(out)
 
 
 role_router_instructions = """You are an intent router that picks exactly one assistant role for the next reply.
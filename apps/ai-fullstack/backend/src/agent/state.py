@@ -28,6 +28,7 @@ class OverallState(TypedDict):
     research_loop_count: int
     reasoning_model: str
     canvas_context: dict
+    _transcript_cache: dict
 
 
 class ReflectionState(TypedDict):
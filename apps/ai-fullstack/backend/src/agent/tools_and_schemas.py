@@ -1,8 +1,16 @@
 from typing import List, Literal, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
+
+# Shared read-only config: one dict for all schema classes, with core-schema
+# construction deferred to first validation instead of module import.
+_SCHEMA_CONFIG = ConfigDict(
+    frozen=True, extra="ignore", revalidate_instances="never", defer_build=True
+)
 
 
 class SearchQueryList(BaseModel):
+    model_config = _SCHEMA_CONFIG
+
     query: List[str] = Field(
         description="A list of search queries to be used for web research."
     )
@@ -12,6 +20,8 @@ class SearchQueryList(BaseModel):
 
 
 class Reflection(BaseModel):
+    model_config = _SCHEMA_CONFIG
+
     is_sufficient: bool = Field(
         description="Whether the provided summaries are sufficient to answer the user's question."
     )
@@ -24,6 +34,8 @@ class Reflection(BaseModel):
 
 
 class RoleDecision(BaseModel):
+    model_config = _SCHEMA_CONFIG
+
     role_id: str = Field(
         description="The id of the role that should answer the user. Must be one of the provided role ids."
     )
@@ -52,6 +64,8 @@ class RoleDecision(BaseModel):
 
 
 class SafetyDecision(BaseModel):
+    model_config = _SCHEMA_CONFIG
+
     sexual: bool = Field(
         default=False,
         description="True if the user request contains explicit sexual content or requests pornographic output.",
@@ -83,22 +97,24 @@ class SafetyDecision(BaseModel):
 
 
 class PromptRequest(BaseModel):
+    model_config = _SCHEMA_CONFIG
+
     workflow: Literal["character_creation", "direct_image", "merchandise"] = Field(
         description="Which creation flow this prompt is for: character creation, direct image, or merchandise."
     )
     subject: str = Field(
         description="Core subject to render, e.g., '拟人狐狸城市探员' 或 '赛博朋克街景'."
     )
-    visual_style: Optional[str] = Field(
-        default=None,
+    visual_style: str = Field(
+        default="",
         description="Optional style or quality cues, e.g., '高端 3D 动画电影质感, PBR'.",
     )
-    model: Optional[str] = Field(
-        default=None,
+    model: str = Field(
+        default="",
         description="Optional model hint (e.g., Sora/Veo/Banana) to tailor camera or fidelity language.",
     )
-    consistency: Optional[str] = Field(
-        default=None,
+    consistency: str = Field(
+        default="",
         description="Optional consistency anchor, e.g., '保持同一角色服装与配色'.",
     )
     language: Literal["zh", "en"] = Field(
@@ -107,16 +123,18 @@ class PromptRequest(BaseModel):
 
 
 class PromptResult(BaseModel):
+    model_config = _SCHEMA_CONFIG
+
     workflow: str = Field(description="Echo of the requested workflow.")
     prompt: str = Field(description="Ready-to-use positive prompt.")
     negative_prompt: str = Field(
         description="Optional negative prompt to avoid common failures."
     )
-    suggested_aspects: List[str] = Field(
-        default_factory=list,
+    suggested_aspects: tuple[str, ...] = Field(
+        default=(),
         description="Key aspects the prompt enforces for consistency.",
     )
-    notes: List[str] = Field(
-        default_factory=list,
+    notes: tuple[str, ...] = Field(
+        default=(),
         description="Extra guidance for the frontend to apply (e.g., camera/background).",
     )
@@ -91,6 +91,79 @@ def insert_citation_markers(text, citations_list):
     return modified_text
 
 
+def annotate_and_collect(response, seg_id: int):
+    """Resolve urls, build citations, and annotate the response text in one pass.
+
+    Fuses `resolve_urls` + `get_citations` + `insert_citation_markers` so the
+    grounding metadata and the response text are each walked once, writing the
+    annotated text into a single list buffer joined at the end.
+
+    Args:
+        response: Gemini response with `candidates[0].grounding_metadata`.
+        seg_id: Segment id used to build the short urls.
+
+    Returns:
+        tuple[str, list[dict]]: the annotated text and the flat list of source
+        segments (label/short_url/value dicts) referenced by the citations.
+    """
+    text = response.text if isinstance(getattr(response, "text", None), str) else ""
+    sources: List[Dict[str, Any]] = []
+    if not response or not response.candidates:
+        return text, sources
+    candidate = response.candidates[0]
+    metadata = getattr(candidate, "grounding_metadata", None)
+    if not metadata or not getattr(metadata, "grounding_supports", None):
+        return text, sources
+
+    chunks = getattr(metadata, "grounding_chunks", None) or []
+    prefix = "https://vertexaisearch.cloud.google.com/id/"
+    resolved_map: Dict[str, str] = {}
+    for idx, chunk in enumerate(chunks):
+        uri = chunk.web.uri
+        if uri not in resolved_map:
+            resolved_map[uri] = f"{prefix}{seg_id}-{idx}"
+
+    citations = []
+    for support in metadata.grounding_supports:
+        segment = getattr(support, "segment", None)
+        if segment is None or segment.end_index is None:
+            continue
+        start_index = segment.start_index if segment.start_index is not None else 0
+        segments: List[Dict[str, Any]] = []
+        for ind in getattr(support, "grounding_chunk_indices", None) or []:
+            try:
+                chunk = chunks[ind]
+                segments.append(
+                    {
+                        "label": chunk.web.title.split(".")[:-1][0],
+                        "short_url": resolved_map.get(chunk.web.uri),
+                        "value": chunk.web.uri,
+                    }
+                )
+            except (IndexError, AttributeError, NameError):
+                pass
+        citations.append((segment.end_index, start_index, -len(citations), segments))
+        sources.extend(segments)
+
+    if not citations:
+        return text, sources
+
+    # Walk the text forward once, splicing markers in ascending end order.
+    # Ties keep the same marker order as insert_citation_markers (which walks
+    # backwards, so later supports at the same index end up first).
+    citations.sort(key=lambda c: (c[0], c[1], c[2]))
+    parts: List[str] = []
+    pos = 0
+    for end_index, _start_index, _order, segments in citations:
+        if end_index > pos:
+            parts.append(text[pos:end_index])
+            pos = end_index
+        for seg in segments:
+            parts.append(f" [{seg['label']}]({seg['short_url']})")
+    parts.append(text[pos:])
+    return "".join(parts), sources
+
+
 def get_citations(response, resolved_urls_map):
     """
     Extracts and formats citation information from a Gemini model's response.